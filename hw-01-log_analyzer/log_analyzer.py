@@ -4,10 +4,15 @@ from copy import copy
 import argparse
 import json
 from string import Template
-from datetime import date
-import gzip
+from datetime import date, datetime, timezone
+import heapq
 from collections import defaultdict
+from functools import lru_cache
 import logging
+import math
+
+# gzip, glob, mmap, tempfile, array and concurrent.futures are imported
+# inside the functions needing them to keep startup of short runs fast
 
 
 config = {
@@ -16,9 +21,68 @@ config = {
     "REPORT_TEMPLATE": "report.html",
     "ERROR_RATE_THRESHOLD": 0.7,
     "LOG_DIR": "./log",
-    "LOG": ""
+    "LOG": "",
+    "DAEMON_HOST": "127.0.0.1",
+    "DAEMON_PORT": 8080,
+    "DAEMON_WORKERS": 2,
+    "DAEMON_SCAN_INTERVAL": 60,
+    "CACHE_DIR": "./cache",
+    "LOGS": [],
+    "DATE_START": "",
+    "DATE_END": "",
+    "WORKERS": 0,
+    "URL_QUERY": "keep",
+    "URL_PLACEHOLDERS": False,
+    "URL_REWRITES": [],
+    "MAX_URLS": 0,
+    "COLUMNAR_DIR": "",
+    "WINDOW": 0,
+    "WINDOW_COUNT": 1440,
+    "WINDOW_MAX_URLS": 1000,
+    "WINDOW_TOP_URLS": 10,
+    "REPORT_SINKS": ["html"],
+    "SQLITE_PATH": "./reports/stats.sqlite"
 }
 
+# Fields of report records in output order
+STATS_FIELDS = ("url", "count", "count_perc", "time_sum", "time_perc",
+                "time_med", "time_avg", "max", "min")
+STATS_SQL_TYPES = {"url": "TEXT", "count": "INTEGER"}
+
+# Log names are logname-yyyymmdd.log[.gz]
+LOG_NAME_RE = re.compile(r'^.*\.(gz|log)$')
+
+# Names of log_format items in order of appearance
+LOG_ITEM_NAMES = ("remote_addr", "remote_user", "http_x_real_ip",
+                  "time_local", "request", "status", "body_bytes_sent",
+                  "http_referer", "http_user_agent", "http_x_forwarded_for",
+                  "http_X_REQUEST_ID", "http_X_RB_USER", "request_time")
+
+# Columns of the columnar log format with array typecodes
+COLUMNS = [("url", "I"), ("status", "I"), ("http_user_agent", "I"),
+           ("request_time", "f"), ("time", "I")]
+# Dictionary-encoded columns with their record fields
+COLUMN_FIELDS = {"url": "request", "status": "status",
+                 "http_user_agent": "http_user_agent"}
+COLUMNAR_MAGIC = b"LACOL\x00\x02\x00"
+
+# Unix time of midnight of "dd/Mon/yyyy:" + "+hhmm" prefixes of time_local
+_day_starts = {}
+
+# URL all requests beyond MAX_URLS distinct ones are accounted to
+OTHER_URL = "other"
+
+# Path segments replaced with placeholders when URL_PLACEHOLDERS is set
+URL_PLACEHOLDER_RULES = [
+    (r"(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+     r"[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)", "{uuid}"),
+    (r"(?<=/)\d+(?=/|$)", "{id}"),
+]
+
+# Relative accuracy of request_time quantiles kept in aggregates
+SKETCH_GAMMA = 1.02
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
 
 def split_by_space(s, item_symbols=("\"", "[", "]")):
     """Split line by spaces but do not split contenst inside quotes.
@@ -56,7 +120,7 @@ def read_log(f):
         yield record
 
 
-def parse_line(s):
+def parse_line(s, url_rules=None):
     """Parse log line according to log format.
 
     log_format  $remote_addr  $remote_user $http_x_real_ip [$time_local]
@@ -67,30 +131,30 @@ def parse_line(s):
 
     Args:
         s (str): log line.
+        url_rules (dict): compiled URL normalization rules.
 
     Returns:
         dict: dict with keys as log item name or None in case of exception.
     """
     try:
-        item_names = ["remote_addr", "remote_user", "http_x_real_ip",
-                      "time_local", "request", "status", "body_bytes_sent",
-                      "http_referer", "http_user_agent",
-                      "http_x_forwarded_for", "http_X_REQUEST_ID",
-                      "http_X_RB_USER", "request_time"]
         item_vals = split_by_space(s)
-        raw_record = {k: v for k, v in zip(item_names, item_vals)}
-        processed_record = process_log_record(raw_record)
+        raw_record = {k: v for k, v in zip(LOG_ITEM_NAMES, item_vals)}
+        processed_record = process_log_record(raw_record, url_rules)
         return processed_record
     except Exception:
         return None
 
 
-def process_log_record(log_dict):
+def process_log_record(log_dict, url_rules=None):
     """
     Process elements of log line.
 
+    Request is split into method, url and protocol, url is
+    normalized with `url_rules` if given.
+
     Args:
         log_dict (dict): dict with log record.
+        url_rules (dict): compiled URL normalization rules.
 
     Returns:
         dict: dict with some values processed.
@@ -102,10 +166,61 @@ def process_log_record(log_dict):
         return s
 
     log_dict["request_time"] = float(remove_symbols(log_dict["request_time"]))
-    log_dict["request"] = log_dict["request"].replace("GET ", "")
+    request = log_dict["request"].strip('"').split(" ")
+    if len(request) == 3:
+        method, url, protocol = request
+    else:
+        method, url, protocol = "", " ".join(request), ""
+    if url_rules is not None:
+        url = normalize_url(url, url_rules)
+    log_dict["request"] = url
+    log_dict["method"] = method
+    log_dict["protocol"] = protocol
     return log_dict
 
 
+def compile_url_rules(config):
+    """Compile URL normalization rules from config.
+
+    URL_QUERY is one of "keep", "drop" or "sort" (query parameters),
+    URL_PLACEHOLDERS replaces numeric and UUID path segments with
+    {id} and {uuid}, URL_REWRITES is a list of [regex, replacement]
+    applied to the path.
+
+    Args:
+        config (dict): configuration.
+
+    Returns:
+        dict: rules for `normalize_url`, picklable to be sent to workers.
+    """
+    rewrites = list(config.get("URL_REWRITES", []))
+    if config.get("URL_PLACEHOLDERS", False):
+        rewrites += URL_PLACEHOLDER_RULES
+    query = config.get("URL_QUERY", "keep")
+    if query not in ("keep", "drop", "sort"):
+        raise ValueError(f"Unknown URL_QUERY mode {query}")
+    return {"query": query,
+            "rewrites": compile_rewrites(tuple(map(tuple, rewrites)))}
+
+
+@lru_cache(maxsize=None)
+def compile_rewrites(rewrites):
+    """Compile (regex, replacement) pairs once per process."""
+    return [(re.compile(p), r) for p, r in rewrites]
+
+
+def normalize_url(url, url_rules):
+    """Normalize url with rules from `compile_url_rules`."""
+    path, sep, query = url.partition("?")
+    for pattern, repl in url_rules["rewrites"]:
+        path = pattern.sub(repl, path)
+    if not sep or url_rules["query"] == "keep":
+        return path + sep + query
+    if url_rules["query"] == "drop":
+        return path
+    return path + sep + "&".join(sorted(query.split("&")))
+
+
 def calc_median(vals):
     vals_sorted = sorted(vals)
     mi = len(vals) // 2
@@ -127,74 +242,705 @@ def select_max_records(data, target_key, limit):
     Returns:
         list: list of dicts.
     """
-    sorted_data = sorted(data, key=lambda x: x[target_key])
-    return sorted_data[-limit:]
+    return heapq.nlargest(limit, data, key=lambda x: x[target_key])[::-1]
 
 
-def analyze_log(data, n_limit):
+def analyze_log(data, n_limit, max_urls=0):
     """Process stats from given log data.
 
     Args:
         data (list): list of dicts of records.
         n_limit (int): maximum number of records.
+        max_urls (int): maximum number of distinct URLs, requests
+            to the ones with the least time_sum are accounted to
+            OTHER_URL (0 for no limit).
 
     Returns:
         list: list of dicts with record stats.
     """
-    time_dict = defaultdict(lambda: {'request_time': []})
+    time_dict = defaultdict(list)
     for log_record in data:
-        request = log_record["request"]
-        request_time = log_record["request_time"]
-        time_dict[request]['request_time'].append(request_time)
+        time_dict[log_record["request"]].append(log_record["request_time"])
+    return stats_from_times(cap_time_dict(time_dict, max_urls), n_limit)
+
+
+def cap_time_dict(time_dict, max_urls):
+    """Keep `max_urls` URLs with the largest time_sum, times of the
+    rest are moved to OTHER_URL (0 for no limit)."""
+    if not max_urls or len(time_dict) <= max_urls:
+        return time_dict
+    time_sums = {url: sum(times) for url, times in time_dict.items()}
+    keep = set(heapq.nlargest(max_urls, time_sums, key=time_sums.get))
+    capped = {OTHER_URL: []}
+    for url, times in time_dict.items():
+        if url in keep:
+            capped[url] = times
+        else:
+            capped[OTHER_URL].extend(times)
+    other = capped[OTHER_URL]
+    warn_other(len(other), sum(other),
+               sum(len(times) for times in time_dict.values()),
+               sum(time_sums.values()))
+    return capped
+
+
+def warn_other(count, time_sum, count_total, time_total):
+    """Log how much of the log was accounted to OTHER_URL."""
+    logging.warning(
+        f"{count} requests ({count / count_total:.1%}) with {time_sum:.3f}s "
+        f"of request time ({time_sum / time_total if time_total else 0:.1%})"
+        f" of URLs beyond MAX_URLS are accounted to {OTHER_URL}")
+
+
+def stats_from_times(time_dict, n_limit):
+    """Build stats of top `n_limit` URLs by time_sum.
+
+    Args:
+        time_dict (dict): URL to list of request times.
+        n_limit (int): maximum number of records.
+
+    Returns:
+        list: list of dicts with record stats.
+    """
+    time_sums = {req: sum(times) for req, times in time_dict.items()}
+    n_requests_total = sum(len(times) for times in time_dict.values())
+    time_total = sum(time_sums.values())
 
-    n_requests_total = sum([len(rq) for rq in time_dict])
-    time_total = sum([sum(time_dict[rq]["request_time"]) for rq in time_dict])
+    # Leave only top records
+    top = heapq.nlargest(n_limit, time_sums, key=time_sums.get)
     stats = []
-    for req in time_dict:
-        req_time = round(sum(time_dict[req]["request_time"]), 5)
-        n_count = len(time_dict[req]["request_time"])
+    for req in reversed(top):
+        times = time_dict[req]
+        req_time = round(time_sums[req], 5)
+        n_count = len(times)
         stats.append({
             "url": req,
             "count": n_count,
             "count_perc": round(n_count / n_requests_total, 5),
             "time_sum": req_time,
-            "time_perc": round(req_time / time_total, 5),
-            "time_med": calc_median(time_dict[req]['request_time']),
-            "time_avg": round(req_time / len(time_dict[req]), 5),
-            "max": max(time_dict[req]['request_time']),
-            "min": min(time_dict[req]['request_time'])
+            "time_perc": round(req_time / time_total, 5) if time_total else 0,
+            "time_med": round(calc_median(times), 5),
+            "time_avg": round(req_time / n_count, 5),
+            "max": round(max(times), 5),
+            "min": round(min(times), 5)
         })
+    return stats
 
-    # Leave only top records
-    if len(stats) > n_limit:
-        stats = select_max_records(stats, "time_sum", n_limit)
 
-    return stats
+def convert_log(path, out_path, chunk_size=65_536):
+    """Convert log to the columnar binary format.
+
+    Columns url, status, http_user_agent (uint32 codes of dictionaries
+    stored in the header), request_time (float32) and time (uint32 unix
+    time, 0 if time_local is broken) are streamed to
+    temporary files in chunks of `chunk_size` rows, so memory does not
+    depend on the log size, only on the number of distinct values.
+    Urls are stored before normalization, rules are applied to the
+    dictionary when the report is built.
+
+    File layout: COLUMNAR_MAGIC, uint64 header length, json header,
+    zero padding to 8 bytes, columns one after another. The header
+    keeps `log_source` of the log to detect stale copies.
 
+    Args:
+        path (str): path to .log or .gz log.
+        out_path (str): path to the columnar file.
+    """
+    import shutil
+    import tempfile
+    from array import array
+
+    source = log_source(path)
+    dicts = {name: {} for name in COLUMN_FIELDS}
+    chunks = {name: array(typecode) for name, typecode in COLUMNS}
+    tmp_files = {name: tempfile.TemporaryFile() for name, _ in COLUMNS}
+    counter = {"records": 0, "broken": 0}
+
+    def flush():
+        for name, chunk in chunks.items():
+            chunk.tofile(tmp_files[name])
+            del chunk[:]
+
+    try:
+        for record in iter_log(path):
+            counter["records"] += 1
+            if record is None:
+                counter["broken"] += 1
+                continue
+            for name, codes in dicts.items():
+                val = record[COLUMN_FIELDS[name]]
+                code = codes.get(val)
+                if code is None:
+                    code = codes[val] = len(codes)
+                chunks[name].append(code)
+            chunks["request_time"].append(record["request_time"])
+            try:
+                chunks["time"].append(parse_time_local(record["time_local"]))
+            except (KeyError, ValueError):
+                chunks["time"].append(0)
+            if len(chunks["request_time"]) >= chunk_size:
+                flush()
+        flush()
+
+        header = {"rows": counter["records"] - counter["broken"],
+                  "records": counter["records"],
+                  "broken": counter["broken"],
+                  "source": source,
+                  "columns": [name for name, _ in COLUMNS],
+                  "dicts": {name: list(codes)
+                            for name, codes in dicts.items()}}
+        header = json.dumps(header).encode()
+        padding = -(len(COLUMNAR_MAGIC) + 8 + len(header)) % 8
+        tmp_path = out_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(COLUMNAR_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header + b"\0" * padding)
+            for name, _ in COLUMNS:
+                tmp_files[name].seek(0)
+                shutil.copyfileobj(tmp_files[name], f)
+        os.replace(tmp_path, out_path)
+    finally:
+        for f in tmp_files.values():
+            f.close()
+
+
+def log_source(path):
+    """Absolute path, size and mtime identifying the log version."""
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size,
+            "mtime": st.st_mtime}
+
+
+def load_columnar(path):
+    """Memory-map columnar file made by `convert_log`.
+
+    Returns:
+        dict: header with "columns" replaced by dict of column name
+            to zero-copy memoryview of the mapped file.
+    """
+    import mmap
+    from array import array
+
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError(f"{path} is not a columnar log")
+    offset = len(COLUMNAR_MAGIC)
+    header_len = int.from_bytes(mm[offset:offset + 8], "little")
+    offset += 8
+    header = json.loads(mm[offset:offset + header_len])
+    offset += header_len + -(offset + header_len) % 8
+
+    view = memoryview(mm)
+    columns = {}
+    for name, typecode in COLUMNS:
+        size = header["rows"] * array(typecode).itemsize
+        columns[name] = view[offset:offset + size].cast(typecode)
+        offset += size
+    header["columns"] = columns
+    return header
+
+
+def analyze_columnar(columnar, n_limit, url_rules=None, max_urls=0):
+    """`analyze_log` over the columnar log from `load_columnar`.
+
+    Normalization rules are applied once per distinct URL.
+    """
+    urls = columnar["dicts"]["url"]
+    if url_rules is not None:
+        urls = [normalize_url(url, url_rules) for url in urls]
+    times_by_code = [[] for _ in urls]
+    columns = columnar["columns"]
+    for code, request_time in zip(columns["url"], columns["request_time"]):
+        times_by_code[code].append(request_time)
+
+    time_dict = {}
+    for url, times in zip(urls, times_by_code):
+        time_dict.setdefault(url, []).extend(times)
+    return stats_from_times(cap_time_dict(time_dict, max_urls), n_limit)
+
+
+def sketch_add(sketch, val):
+    """Add value to the quantile sketch.
+
+    Sketch is a dict of logarithmic bucket index to count, values
+    inside a bucket differ by at most SKETCH_GAMMA times. Non-positive
+    values go to the bucket None.
+    """
+    i = math.floor(math.log(val) / SKETCH_LOG_GAMMA) if val > 0 else None
+    sketch[i] = sketch.get(i, 0) + 1
+
+
+def sketch_quantile(sketch, q):
+    """Approximate q-quantile (0..1) of values added to the sketch."""
+    n_total = sum(sketch.values())
+    if n_total == 0:
+        return None
+    rank = q * (n_total - 1)
+    n_seen = sketch.get(None, 0)
+    if n_seen > rank:
+        return 0.0
+    for i in sorted(k for k in sketch if k is not None):
+        n_seen += sketch[i]
+        if n_seen > rank:
+            return round(SKETCH_GAMMA ** (i + 0.5), 5)
+
+
+def new_aggregate():
+    """Create empty per-URL aggregate."""
+    return {"count": 0, "time_sum": 0.0, "time_max": 0.0,
+            "time_min": math.inf, "sketch": {}}
+
+
+def aggregate_records(records, urls=None, max_urls=0):
+    """Accumulate per-URL aggregates from parsed records.
+
+    Unlike `analyze_log` aggregates do not keep every request_time,
+    so their memory is bounded by the number of distinct URLs and
+    aggregates of different logs can be merged.
+
+    Args:
+        records (iterable): parsed log records.
+        urls (dict): aggregates to update, new dict if None.
+        max_urls (int): maximum number of distinct URLs, see
+            `evict_urls` (0 for no limit).
+
+    Returns:
+        dict: URL to aggregate dict.
+    """
+    if urls is None:
+        urls = {}
+    for log_record in records:
+        aggregate_add(urls, log_record["request"],
+                      log_record["request_time"], max_urls)
+    evict_urls(urls, max_urls)
+    return urls
+
+
+def aggregate_add(urls, request, request_time, max_urls=0):
+    """Account single request to per-URL aggregates.
+
+    With `max_urls` the table grows up to twice of it before URLs
+    with the least time_sum are evicted to OTHER_URL.
+    """
+    agg = urls.get(request)
+    if agg is None:
+        if max_urls and len(urls) > 2 * max_urls:
+            evict_urls(urls, max_urls)
+        agg = urls[request] = new_aggregate()
+    agg["count"] += 1
+    agg["time_sum"] += request_time
+    if request_time > agg["time_max"]:
+        agg["time_max"] = request_time
+    if request_time < agg["time_min"]:
+        agg["time_min"] = request_time
+    sketch_add(agg["sketch"], request_time)
+
+
+def evict_urls(urls, max_urls):
+    """Merge aggregates of all but `max_urls` URLs with the largest
+    time_sum into OTHER_URL (0 for no limit).
+
+    Heavy hitters are kept no matter when they were first seen: an
+    expensive URL is not lost to OTHER_URL only because the table was
+    full when it appeared.
+    """
+    n_evict = len(urls) - (OTHER_URL in urls) - max_urls
+    if not max_urls or n_evict <= 0:
+        return
+    evicted = heapq.nsmallest(n_evict, (url for url in urls
+                                        if url != OTHER_URL),
+                              key=lambda url: urls[url]["time_sum"])
+    other = urls.setdefault(OTHER_URL, new_aggregate())
+    for url in evicted:
+        merge_aggregate(other, urls.pop(url))
+
+
+def warn_evicted(urls):
+    """`warn_other` for per-URL aggregates with evicted URLs."""
+    other = urls.get(OTHER_URL)
+    if other is not None:
+        warn_other(other["count"], other["time_sum"],
+                   sum(agg["count"] for agg in urls.values()),
+                   sum(agg["time_sum"] for agg in urls.values()))
+
+
+def merge_aggregate(dst, src):
+    """Merge single aggregate src into dst."""
+    dst["count"] += src["count"]
+    dst["time_sum"] += src["time_sum"]
+    dst["time_max"] = max(dst["time_max"], src["time_max"])
+    dst["time_min"] = min(dst["time_min"], src["time_min"])
+    for i, n in src["sketch"].items():
+        dst["sketch"][i] = dst["sketch"].get(i, 0) + n
+
+
+def merge_aggregates(dst, src, max_urls=0):
+    """Merge per-URL aggregates src into dst.
+
+    URLs beyond `max_urls` distinct ones are evicted to OTHER_URL,
+    see `evict_urls`.
+    """
+    for url, agg in src.items():
+        cur = dst.get(url)
+        if cur is None:
+            dst[url] = {**agg, "sketch": dict(agg["sketch"])}
+        else:
+            merge_aggregate(cur, agg)
+    evict_urls(dst, max_urls)
+    return dst
+
+
+def url_stats(url, agg, n_requests_total, time_total):
+    """Build report record of a single URL from its aggregate."""
+    req_time = round(agg["time_sum"], 5)
+    return {
+        "url": url,
+        "count": agg["count"],
+        "count_perc": round(agg["count"] / n_requests_total, 5),
+        "time_sum": req_time,
+        "time_perc": round(req_time / time_total, 5) if time_total else 0,
+        "time_med": sketch_quantile(agg["sketch"], 0.5),
+        "time_avg": round(req_time / agg["count"], 5),
+        "max": agg["time_max"],
+        "min": agg["time_min"]
+    }
+
+
+def stats_from_aggregates(urls, n_limit):
+    """Build `analyze_log`-style stats from per-URL aggregates.
+
+    Args:
+        urls (dict): URL to aggregate dict.
+        n_limit (int): maximum number of records.
+
+    Returns:
+        list: list of dicts with record stats.
+    """
+    n_requests_total = sum(agg["count"] for agg in urls.values())
+    time_total = sum(agg["time_sum"] for agg in urls.values())
+    top = heapq.nlargest(n_limit, urls.items(),
+                         key=lambda x: x[1]["time_sum"])
+    return [url_stats(url, agg, n_requests_total, time_total)
+            for url, agg in reversed(top)]
+
+
+def iter_log(path, url_rules=None):
+    """Generator of parsed records of log file, None for broken ones."""
+    is_gz = path.endswith("gz")
+    if is_gz:
+        import gzip
+    with gzip.open(path, 'rb') if is_gz else open(path, "r") as f:
+        for line in read_log(f):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            yield parse_line(line, url_rules)
+
+
+def aggregate_log_file(path, url_rules=None, max_urls=0):
+    """Parse log file into per-URL aggregates.
+
+    Args:
+        path (str): path to .log or .gz log.
+        url_rules (dict): compiled URL normalization rules.
+        max_urls (int): maximum number of distinct URLs.
+
+    Returns:
+        (dict, int, int): URL to aggregate dict, number of records,
+            number of broken records.
+    """
+    counter = {"records": 0, "broken": 0}
+
+    def valid_records():
+        for record in iter_log(path, url_rules):
+            counter["records"] += 1
+            if record is None:
+                counter["broken"] += 1
+            else:
+                yield record
 
-def parse_json(stats, config, log_date):
+    urls = aggregate_records(valid_records(), max_urls=max_urls)
+    return urls, counter["records"], counter["broken"]
+
+
+def parse_time_local(s):
+    """Convert $time_local like [29/Jun/2017:03:50:00 +0300] to unix time.
+
+    strptime is called once per day and timezone, the rest of
+    lines only parse hours, minutes and seconds.
+    """
+    s = s.strip("[]")
+    key = s[:12] + s[21:]
+    day_start = _day_starts.get(key)
+    if day_start is None:
+        day_start = datetime.strptime(key, "%d/%b/%Y:%z").timestamp()
+        day_start = _day_starts[key] = int(day_start)
+    return day_start + int(s[12:14]) * 3600 + int(s[15:17]) * 60 \
+        + int(s[18:20])
+
+
+def iter_timed_requests(records):
+    """Generator of (unix time, url, request_time) of records,
+    records with broken time_local are skipped."""
+    for record in records:
+        try:
+            ts = parse_time_local(record["time_local"])
+        except (KeyError, ValueError):
+            continue
+        yield ts, record["request"], record["request_time"]
+
+
+def window_summary(start, window, n_top):
+    """Report record of a finished window."""
+    total = window["total"][None]
+    urls = heapq.nlargest(n_top, window["urls"].items(),
+                          key=lambda x: x[1]["time_sum"])
+    return {
+        "start": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+        "count": total["count"],
+        "time_sum": round(total["time_sum"], 5),
+        "time_p50": sketch_quantile(total["sketch"], 0.5),
+        "time_p95": sketch_quantile(total["sketch"], 0.95),
+        "time_p99": sketch_quantile(total["sketch"], 0.99),
+        "urls": [{"url": url,
+                  "count": agg["count"],
+                  "time_p50": sketch_quantile(agg["sketch"], 0.5),
+                  "time_p95": sketch_quantile(agg["sketch"], 0.95)}
+                 for url, agg in urls]
+    }
+
+
+def aggregate_windows(requests, window, max_windows=1440, max_urls=1000,
+                      n_top=10):
+    """Aggregate requests into time windows.
+
+    At most `max_windows` windows are open, when a new one is opened
+    the oldest is summarized and dropped, so memory does not depend
+    on the log length. Requests older than every open window are
+    counted as late and skipped.
+
+    Args:
+        requests (iterable): (unix time, url, request_time) tuples.
+        window (int): window length in seconds.
+        max_windows (int): number of open windows.
+        max_urls (int): maximum number of distinct URLs per window.
+        n_top (int): number of URLs by time_sum in window summary.
+
+    Returns:
+        dict: "windows" - summaries sorted by start, "peak" - summary
+            of the window with most requests (None if no requests),
+            "late" - number of skipped late requests.
+    """
+    open_starts = []
+    windows = {}
+    summaries = []
+    n_late = 0
+    for ts, url, request_time in requests:
+        start = ts - ts % window
+        cur = windows.get(start)
+        if cur is None:
+            if len(open_starts) == max_windows and start < open_starts[0]:
+                n_late += 1
+                continue
+            cur = windows[start] = {"total": {}, "urls": {}}
+            heapq.heappush(open_starts, start)
+            if len(open_starts) > max_windows:
+                oldest = heapq.heappop(open_starts)
+                summaries.append(window_summary(
+                    oldest, windows.pop(oldest), n_top))
+        aggregate_add(cur["total"], None, request_time)
+        aggregate_add(cur["urls"], url, request_time, max_urls)
+
+    for start in open_starts:
+        summaries.append(window_summary(start, windows[start], n_top))
+    summaries.sort(key=lambda x: x["start"])
+    peak = max(summaries, key=lambda x: x["count"], default=None)
+    return {"windows": summaries, "peak": peak, "late": n_late}
+
+
+def report_path(config, log_date, ext):
+    """Path of the report file in REPORT_DIR, directory is created."""
+    if not os.path.exists(config["REPORT_DIR"]):
+        os.makedirs(config["REPORT_DIR"])
+    fn = f"report-{str(log_date)}.{ext}"
+    path = os.path.join(config["REPORT_DIR"], fn)
+    logging.info(f"Report destination path: {path}")
+    return path
+
+
+def parse_json(stats, config, log_date, windows=None):
     """Parse json stats to the html report.
 
+    Rows are written one by one into the template instead of
+    substituting the whole table as one string.
+
     Args:
         stats (list): list of dicts with stats.
         config (dict): configuration.
         log_date (date): date of log generation (used in report name).
+        windows (dict): time windows from `aggregate_windows`.
     """
-    if not os.path.exists(config["REPORT_DIR"]):
-        os.makedirs(config["REPORT_DIR"])
-    fn = f"report-{str(log_date)}.html"
-    report_path = os.path.join(config["REPORT_DIR"], fn)
-    logging.info(f"Report destination path: {report_path}")
+    path = report_path(config, log_date, "html")
 
     with open(config["REPORT_TEMPLATE"], "r") as f:
         report_html = f.read()
-    report_html = Template(report_html)
+    if windows is None:
+        windows = {"windows": [], "peak": None, "late": 0}
+    head, sep, tail = report_html.partition("$table_json")
+    head, tail = [Template(part).safe_substitute(
+                  windows_json=json.dumps(windows)) for part in (head, tail)]
+
+    with open(path, 'w') as f:
+        f.write(head)
+        if sep:
+            f.write("[")
+            for i, record in enumerate(stats):
+                f.write(", " + str(record) if i else str(record))
+            f.write("]")
+        f.write(tail)
+    logging.info(f"Report has been written successfully.")
 
-    report_out = str(report_html.safe_substitute(table_json=str(stats)))
 
-    with open(report_path, 'w') as f:
-        f.write(report_out)
-    logging.info(f"Report has been written successfully.")
+def write_ndjson(stats, config, log_date, windows=None):
+    """Write stats as newline-delimited json, one URL per line."""
+    path = report_path(config, log_date, "ndjson")
+    with open(path, "w") as f:
+        for record in stats:
+            f.write(json.dumps(record))
+            f.write("\n")
+
+
+def write_csv(stats, config, log_date, windows=None):
+    """Write stats as csv with STATS_FIELDS columns."""
+    import csv
+
+    path = report_path(config, log_date, "csv")
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=STATS_FIELDS)
+        writer.writeheader()
+        writer.writerows(stats)
+
+
+def write_sqlite(stats, config, log_date, windows=None):
+    """Insert stats into SQLITE_PATH database.
+
+    All rows of the report are inserted by one executemany in one
+    transaction, rows of the same report date are replaced, so the
+    table keeps history of all reports.
+    """
+    import sqlite3
+
+    db_dir = os.path.dirname(config["SQLITE_PATH"])
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    db = sqlite3.connect(config["SQLITE_PATH"])
+    try:
+        with db:
+            columns = ", ".join(f"{k} {STATS_SQL_TYPES.get(k, 'REAL')}"
+                                for k in STATS_FIELDS)
+            db.execute(f"CREATE TABLE IF NOT EXISTS url_stats ("
+                       f"report_date TEXT, {columns}, "
+                       f"PRIMARY KEY (report_date, url))")
+            db.execute("DELETE FROM url_stats WHERE report_date = ?",
+                       (str(log_date),))
+            db.executemany(
+                f"INSERT INTO url_stats VALUES "
+                f"(?, {', '.join('?' * len(STATS_FIELDS))})",
+                ((str(log_date), *(rec[k] for k in STATS_FIELDS))
+                 for rec in stats))
+    finally:
+        db.close()
+    logging.info(f"{len(stats)} rows written to {config['SQLITE_PATH']}")
+
+
+# Report writers by REPORT_SINKS names
+SINKS = {
+    "html": parse_json,
+    "ndjson": write_ndjson,
+    "csv": write_csv,
+    "sqlite": write_sqlite,
+}
+
+
+def report_sinks(config):
+    """Writers of REPORT_SINKS, all names are checked at once."""
+    names = config.get("REPORT_SINKS", ["html"])
+    unknown = [name for name in names if name not in SINKS]
+    if unknown:
+        raise ValueError(f"Unknown report sinks {', '.join(unknown)}")
+    return [SINKS[name] for name in names]
+
+
+def write_report(stats, config, log_date, windows=None):
+    """Write stats to every sink in REPORT_SINKS.
+
+    Nothing is written if any of the sinks is unknown.
+    """
+    for sink in report_sinks(config):
+        sink(stats, config, log_date, windows)
+
+
+def parse_log_date(fn):
+    """Date of log with name logname-yyyymmdd.log[.gz] or None."""
+    if not LOG_NAME_RE.match(fn):
+        return None
+    datestr = fn[fn.rfind('-')+1:fn.rfind('.')]
+    try:
+        return date(int(datestr[:4]), int(datestr[4:6]), int(datestr[6:8]))
+    except ValueError:
+        return None
+
+
+def list_logs(log_dir):
+    """List all logs in given directory with their dates.
+
+    Logs have format of logname-yyyymmdd.log[.gz], directory is
+    looked through non-recursevely.
+
+    Args:
+        log_dir (str): direcotry with logs.
+
+    Returns:
+        list: list of (path, date) tuples.
+    """
+    logs = []
+    for fn in os.listdir(log_dir):
+        dt = parse_log_date(fn)
+        if dt is not None:
+            logs.append((os.path.join(log_dir, fn), dt))
+    return logs
+
+
+def collect_logs(sources, date_start=None, date_end=None):
+    """Collect logs from directories and glob patterns.
+
+    Args:
+        sources (list): directories or glob patterns of log files.
+        date_start (date): skip logs older than this date if set.
+        date_end (date): skip logs newer than this date if set.
+
+    Returns:
+        list: sorted list of (path, date) tuples, one per real file.
+    """
+    import glob
+
+    found = []
+    for source in sources:
+        if os.path.isdir(source):
+            found.extend(list_logs(source))
+            continue
+        for p in glob.glob(source):
+            dt = parse_log_date(os.path.basename(p))
+            if dt is not None:
+                found.append((p, dt))
+    # Same file may be reached by several sources (./log and log/*.gz)
+    logs = {}
+    for p, dt in found:
+        logs.setdefault(os.path.realpath(p), (p, dt))
+    return sorted((p, dt) for p, dt in logs.values()
+                  if (date_start is None or dt >= date_start)
+                  and (date_end is None or dt <= date_end))
 
 
 def select_recent_log(log_dir):
@@ -214,11 +960,7 @@ def select_recent_log(log_dir):
     """
     path = ""
     max_date = date(1900, 1, 1)
-    fns = [f for f in os.listdir(log_dir) if re.match(r'^.*\.(gz|log)$', f)]
-    for fn in fns:
-        datestr = fn[fn.rfind('-')+1:fn.rfind('.')]
-        p = os.path.join(log_dir, fn)
-        dt = date(int(datestr[:4]), int(datestr[4:6]), int(datestr[6:8]))
+    for p, dt in list_logs(log_dir):
         if dt > max_date:
             max_date = dt
             path = p
@@ -249,6 +991,12 @@ def build_report(config):
                         datefmt="%Y.%m.%d %H:%M:%S", level=logging.INFO,
                         **kwargs)
 
+    # Fail on misconfigured sinks before parsing logs
+    report_sinks(config)
+    if config.get("LOGS"):
+        build_merged_report(config)
+        return
+
     # Check that direcory in config exists
     if not os.path.exists(config["LOG_DIR"]):
         raise Exception(f"Directory {config['LOG_DIR']} not exists")
@@ -260,18 +1008,25 @@ def build_report(config):
         logging.warning(f"Report from {log_date} already exists. Exiting.")
     logging.info(f"Processing {path}")
 
-    i_record = 0
-    n_broke_records = 0
-    data = []
-    is_gz = path.endswith("gz")
-    with gzip.open(path, 'rb') if is_gz else open(path, "r") as f:
-        for line in read_log(f):
+    url_rules = compile_url_rules(config)
+    if config.get("COLUMNAR_DIR"):
+        build_report_columnar(config, path, log_date, url_rules)
+        return
+
+    max_urls = config.get("MAX_URLS", 0)
+    if max_urls:
+        # Aggregates instead of every record and request time, so
+        # memory is bounded by MAX_URLS, not by the log size
+        urls, i_record, n_broke_records = aggregate_log_file(
+            path, url_rules, max_urls)
+    else:
+        i_record = 0
+        n_broke_records = 0
+        data = []
+        for parsed_record in iter_log(path, url_rules):
             i_record += 1
             if i_record % 100_000 == 0:
                 logging.info(f"Processed {i_record} records")
-            if isinstance(line, bytes):
-                line = line.decode('utf-8')
-            parsed_record = parse_line(line)
             if parsed_record is None:
                 n_broke_records += 1
             else:
@@ -285,10 +1040,155 @@ def build_report(config):
     elif error_rate > 0:
         logging.warning(f"Parsing error rate is {error_rate}")
 
-    logging.info(f"Log contains {len(data)} records")
-    stats = analyze_log(data, config["REPORT_SIZE"])
+    logging.info(f"Log contains {i_record - n_broke_records} records")
+    if max_urls:
+        warn_evicted(urls)
+        stats = stats_from_aggregates(urls, config["REPORT_SIZE"])
+    else:
+        stats = analyze_log(data, config["REPORT_SIZE"])
+    logging.info(f"Stats contains {len(stats)} requests")
+    windows = None
+    if config.get("WINDOW"):
+        if max_urls:
+            # Second pass over the log instead of keeping records
+            data = (r for r in iter_log(path, url_rules) if r is not None)
+        windows = build_windows(config, iter_timed_requests(data))
+    write_report(stats, config, log_date, windows)
+
+
+def build_windows(config, requests):
+    """Aggregate (unix time, url, request_time) requests into windows
+    of WINDOW seconds according to config."""
+    windows = aggregate_windows(requests, config["WINDOW"],
+                                config.get("WINDOW_COUNT", 1440),
+                                config.get("WINDOW_MAX_URLS", 1000),
+                                config.get("WINDOW_TOP_URLS", 10))
+    if windows["late"] > 0:
+        logging.warning(f"{windows['late']} requests are older than "
+                        f"open windows and were skipped")
+    if windows["peak"] is not None:
+        logging.info(f"Peak window starts at {windows['peak']['start']} "
+                     f"with {windows['peak']['count']} requests")
+    return windows
+
+
+def build_report_columnar(config, path, log_date, url_rules):
+    """Build report of the log through its columnar copy in COLUMNAR_DIR.
+
+    The log is converted once, following reports of the same log
+    only read the memory-mapped columnar file.
+    """
+    import hashlib
+
+    if not os.path.exists(config["COLUMNAR_DIR"]):
+        os.makedirs(config["COLUMNAR_DIR"])
+    # Same-named logs of different hosts may share COLUMNAR_DIR
+    path_hash = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    col_path = os.path.join(config["COLUMNAR_DIR"],
+                            f"{os.path.basename(path)}-{path_hash[:12]}.col")
+    columnar = None
+    if os.path.exists(col_path):
+        try:
+            columnar = load_columnar(col_path)
+        except ValueError as e:
+            # Made by other version of the format or damaged
+            logging.warning(str(e))
+    if columnar is None or columnar.get("source") != log_source(path):
+        logging.info(f"Converting {path} to {col_path}")
+        convert_log(path, col_path)
+        columnar = load_columnar(col_path)
+
+    error_rate = columnar["broken"] / columnar["records"]
+    if error_rate > config["ERROR_RATE_THRESHOLD"]:
+        logging.exception(f"Parsing error rate is {error_rate}. Exiting...")
+        return
+    elif error_rate > 0:
+        logging.warning(f"Parsing error rate is {error_rate}")
+
+    logging.info(f"Log contains {columnar['rows']} records")
+    stats = analyze_columnar(columnar, config["REPORT_SIZE"], url_rules,
+                             config.get("MAX_URLS", 0))
+    logging.info(f"Stats contains {len(stats)} requests")
+    windows = None
+    if config.get("WINDOW"):
+        urls = columnar["dicts"]["url"]
+        if url_rules is not None:
+            urls = [normalize_url(url, url_rules) for url in urls]
+        columns = columnar["columns"]
+        requests = ((ts, urls[code], request_time)
+                    for ts, code, request_time in zip(
+                        columns["time"], columns["url"],
+                        columns["request_time"]) if ts)
+        windows = build_windows(config, requests)
+    write_report(stats, config, log_date, windows)
+
+
+def build_merged_report(config):
+    """Merge logs from config["LOGS"] into one html report.
+
+    Logs are aggregated in parallel by WORKERS processes (all cores
+    if 0), per-URL aggregates are merged as soon as each log is done,
+    so memory is bounded by the number of distinct URLs.
+
+    Args:
+        config (dict): configuration file.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    for option in ("WINDOW", "COLUMNAR_DIR"):
+        if config.get(option):
+            logging.warning(f"{option} is not used with LOGS, "
+                            f"merged report is built without it")
+
+    date_start = (date.fromisoformat(config["DATE_START"])
+                  if config["DATE_START"] else None)
+    date_end = (date.fromisoformat(config["DATE_END"])
+                if config["DATE_END"] else None)
+    logs = collect_logs(config["LOGS"], date_start, date_end)
+    if len(logs) == 0:
+        logging.warning("No logs found.")
+        return
+    logging.info(f"Merging {len(logs)} logs")
+
+    urls = {}
+    n_records = 0
+    n_broke_records = 0
+    url_rules = compile_url_rules(config)
+    max_urls = config.get("MAX_URLS", 0)
+    workers = config["WORKERS"] or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(aggregate_log_file, p, url_rules, max_urls): p
+                   for p, _ in logs}
+        for future in as_completed(futures):
+            try:
+                log_urls, log_records, log_broken = future.result()
+            except Exception as e:
+                logging.error(f"Failed to process {futures[future]}: {e}. "
+                              f"Skipping.")
+                continue
+            error_rate = log_broken / log_records if log_records else 1
+            if error_rate > config["ERROR_RATE_THRESHOLD"]:
+                logging.error(f"Parsing error rate of {futures[future]} is "
+                              f"{error_rate}. Skipping.")
+                continue
+            n_records += log_records
+            n_broke_records += log_broken
+            merge_aggregates(urls, log_urls, max_urls)
+            logging.info(f"Processed {futures[future]}")
+
+    if n_records == 0:
+        logging.error("No valid logs to merge. Exiting...")
+        return
+    if n_broke_records > 0:
+        logging.warning(f"Parsing error rate is "
+                        f"{n_broke_records / n_records}")
+
+    warn_evicted(urls)
+    stats = stats_from_aggregates(urls, config["REPORT_SIZE"])
     logging.info(f"Stats contains {len(stats)} requests")
-    parse_json(stats, config, log_date)
+    first, last = logs[0][1], logs[-1][1]
+    report_date = str(first) if first == last else f"{first}_{last}"
+    write_report(stats, config, report_date)
 
 
 def main(config):
@@ -303,6 +1203,14 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Log Analyser util")
     parser.add_argument("--config", type=str, default="",
                         help="path to the .yml config")
+    parser.add_argument("--logs", type=str, nargs="+", default=[],
+                        help="directories or glob patterns of logs to merge")
+    parser.add_argument("--start", type=str, default="",
+                        help="merge logs not older than yyyy-mm-dd")
+    parser.add_argument("--end", type=str, default="",
+                        help="merge logs not newer than yyyy-mm-dd")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of processes to merge logs with")
     args = parser.parse_args()
     return args
 
@@ -337,4 +1245,8 @@ def process_config(config_path):
 if __name__ == "__main__":
     args = parse_args()
     config = process_config(args.config)
+    for key, val in (("LOGS", args.logs), ("DATE_START", args.start),
+                     ("DATE_END", args.end), ("WORKERS", args.workers)):
+        if val:
+            config[key] = val
     main(config)
@@ -0,0 +1,231 @@
+import os
+import json
+import asyncio
+import logging
+import argparse
+from datetime import date
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from log_analyzer import (list_logs, aggregate_log_file, merge_aggregates,
+                          stats_from_aggregates, url_stats, process_config,
+                          compile_url_rules)
+
+
+class LogDaemon:
+    """Resident log analyzer.
+
+    Keeps per-day per-URL aggregates in memory (and in CACHE_DIR on
+    disk, so restarts do not reparse logs), periodically ingests new
+    logs from LOG_DIR in a bounded process pool and answers local
+    HTTP/JSON queries:
+
+        GET /dates                              days with ingested logs
+        GET /top?date=yyyy-mm-dd&n=10           top-N URLs by time_sum
+        GET /url?date=yyyy-mm-dd&url=/api/...   stats of a single URL
+        GET /range?start=yyyy-mm-dd&end=yyyy-mm-dd&n=10
+                                                top-N URLs over date range
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.days = {}
+        self.ingested = set()
+        self.url_rules = compile_url_rules(config)
+        self.max_urls = config.get("MAX_URLS", 0)
+        self.pool = self.new_pool()
+        self.load_cache()
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.config["DAEMON_WORKERS"])
+
+    def restart_pool(self):
+        # Dead worker (e.g. killed by OOM) breaks the pool for good
+        logging.error("Worker pool is broken, restarting it")
+        self.pool.shutdown(wait=False)
+        self.pool = self.new_pool()
+
+    def cache_path(self):
+        return os.path.join(self.config["CACHE_DIR"], "aggregates.json")
+
+    def load_cache(self):
+        """Restore aggregates of previous runs from CACHE_DIR."""
+        if not os.path.exists(self.cache_path()):
+            return
+        try:
+            with open(self.cache_path()) as f:
+                cache = json.load(f)
+            ingested = set(cache["ingested"])
+            days = {}
+            for day, urls in cache["days"].items():
+                for agg in urls.values():
+                    agg["sketch"] = {None if i == "null" else int(i): n
+                                     for i, n in agg["sketch"].items()}
+                days[date.fromisoformat(day)] = urls
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error(f"Cache {self.cache_path()} is broken: {e}. "
+                          f"Starting with empty aggregates")
+            return
+        self.ingested, self.days = ingested, days
+        logging.info(f"Loaded {len(self.days)} days from cache")
+
+    def save_cache(self):
+        if not os.path.exists(self.config["CACHE_DIR"]):
+            os.makedirs(self.config["CACHE_DIR"])
+        cache = {"ingested": sorted(self.ingested),
+                 "days": {str(day): urls for day, urls in self.days.items()}}
+        tmp_path = self.cache_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.cache_path())
+
+    async def ingest(self):
+        """Aggregate logs from LOG_DIR that were not ingested yet.
+
+        Logs that failed or were rejected by error rate are retried on
+        the next scan.
+        """
+        if not os.path.exists(self.config["LOG_DIR"]):
+            logging.warning(f"Directory {self.config['LOG_DIR']} not exists")
+            return
+        new_logs = [(p, dt) for p, dt in list_logs(self.config["LOG_DIR"])
+                    if p not in self.ingested]
+        if not new_logs:
+            return
+
+        loop = asyncio.get_running_loop()
+
+        def submit_all():
+            return [loop.run_in_executor(self.pool, aggregate_log_file, p,
+                                         self.url_rules, self.max_urls)
+                    for p, _ in new_logs]
+
+        try:
+            futures = submit_all()
+        except BrokenProcessPool:
+            self.restart_pool()
+            futures = submit_all()
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        if any(isinstance(res, BrokenProcessPool) for res in results):
+            self.restart_pool()
+
+        for (path, dt), res in zip(new_logs, results):
+            if isinstance(res, Exception):
+                logging.error(f"Failed to process {path}: {res}")
+                continue
+            urls, n_records, n_broken = res
+            error_rate = n_broken / n_records if n_records else 1
+            if error_rate > self.config["ERROR_RATE_THRESHOLD"]:
+                logging.error(f"Parsing error rate of {path} is "
+                              f"{error_rate}. Skipping.")
+                continue
+            merge_aggregates(self.days.setdefault(dt, {}), urls,
+                             self.max_urls)
+            self.ingested.add(path)
+            logging.info(f"Ingested {path}: {n_records} records")
+        # Aggregates are mutated only here, so dumping them from another
+        # thread is safe while the loop keeps answering queries
+        await loop.run_in_executor(None, self.save_cache)
+
+    async def ingest_forever(self):
+        while True:
+            try:
+                await self.ingest()
+            except Exception as e:
+                logging.exception(e)
+            await asyncio.sleep(self.config["DAEMON_SCAN_INTERVAL"])
+
+    def query(self, target):
+        """Answer query of the HTTP target (path with query string).
+
+        Returns:
+            (int, object): HTTP status and json-serializable body.
+        """
+        url = urlsplit(target)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            n = int(params.get("n", self.config["REPORT_SIZE"]))
+            if url.path == "/dates":
+                return 200, sorted(str(day) for day in self.days)
+            elif url.path == "/top":
+                urls = self.days.get(date.fromisoformat(params["date"]))
+                if urls is None:
+                    return 404, {"error": "no logs for given date"}
+                return 200, stats_from_aggregates(urls, n)[::-1]
+            elif url.path == "/url":
+                urls = self.days.get(date.fromisoformat(params["date"]))
+                if urls is None or params["url"] not in urls:
+                    return 404, {"error": "no such url for given date"}
+                n_total = sum(agg["count"] for agg in urls.values())
+                time_total = sum(agg["time_sum"] for agg in urls.values())
+                return 200, url_stats(params["url"], urls[params["url"]],
+                                      n_total, time_total)
+            elif url.path == "/range":
+                start = date.fromisoformat(params["start"])
+                end = date.fromisoformat(params["end"])
+                merged = {}
+                for day, urls in self.days.items():
+                    if start <= day <= end:
+                        merge_aggregates(merged, urls)
+                return 200, stats_from_aggregates(merged, n)[::-1]
+        except (KeyError, ValueError) as e:
+            return 400, {"error": f"bad request: {e}"}
+        return 404, {"error": "unknown endpoint"}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip headers, only GET without body is supported
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3 or parts[0] != "GET":
+                status, body = 405, {"error": "only GET is supported"}
+            else:
+                status, body = self.query(parts[1])
+            payload = json.dumps(body).encode()
+            writer.write(f"HTTP/1.1 {status} \r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(payload)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle,
+                                            self.config["DAEMON_HOST"],
+                                            self.config["DAEMON_PORT"])
+        logging.info(f"Listening on {self.config['DAEMON_HOST']}:"
+                     f"{self.config['DAEMON_PORT']}")
+        async with server:
+            await asyncio.gather(server.serve_forever(),
+                                 self.ingest_forever())
+
+
+def main(config):
+    kwargs = {"filename": config["LOG"]} if len(config["LOG"]) != 0 else {}
+    logging.basicConfig(format="[%(asctime)s] %(levelname).1s %(message)s",
+                        datefmt="%Y.%m.%d %H:%M:%S", level=logging.INFO,
+                        **kwargs)
+    daemon = LogDaemon(config)
+    try:
+        asyncio.run(daemon.serve())
+    finally:
+        daemon.pool.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Log Analyser daemon")
+    parser.add_argument("--config", type=str, default="",
+                        help="path to the .json config")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(process_config(args.config))
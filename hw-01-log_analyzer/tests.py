@@ -1,12 +1,47 @@
+import asyncio
 import gzip
 from datetime import datetime
+import json
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
 import unittest
-
-from log_analyzer import select_recent_log, build_report
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
+
+from log_analyzer import (select_recent_log, build_report, list_logs,
+                          collect_logs, compile_url_rules, normalize_url,
+                          analyze_log, OTHER_URL, iter_log, convert_log,
+                          load_columnar, analyze_columnar, parse_time_local,
+                          aggregate_windows, aggregate_records,
+                          stats_from_aggregates, write_report)
+from log_daemon import LogDaemon
 from utils import generate_logs
 
 
+FIXTURE_DIR = "./test_data/fixture_log"
+
+
+def setUpModule():
+    """Generate logs once for all test cases."""
+    generate_logs("nginx-access-ui.log-20170630.gz", FIXTURE_DIR, 10)
+
+
+def tearDownModule():
+    shutil.rmtree(FIXTURE_DIR)
+
+
+def copy_fixture_logs(dest_dir, n_logs=None):
+    """Copy first n_logs (all if None) generated logs to dest_dir."""
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    for fn in sorted(os.listdir(FIXTURE_DIR))[:n_logs]:
+        shutil.copy(os.path.join(FIXTURE_DIR, fn), dest_dir)
+
+
 def get_cur_date():
     """Return current yyyy, mm, dd. """
     dt = datetime.today()
@@ -74,8 +109,7 @@ class TestLogAnalyzer(unittest.TestCase):
         }
         if not os.path.exists(cls.config["LOG_DIR"]):
             os.makedirs(cls.config["LOG_DIR"])
-        generate_logs("nginx-access-ui.log-20170630.gz",
-                      cls.config["LOG_DIR"], 10)
+        copy_fixture_logs(cls.config["LOG_DIR"])
         if not os.path.exists(cls.config["REPORT_DIR"]):
             os.makedirs(cls.config["REPORT_DIR"])
 
@@ -186,3 +220,347 @@ class TestLogAnalyzer(unittest.TestCase):
 
         self.assertFalse(os.path.exists(fn_report_out))
         os.system(f"rm {fn_report_out}; rm {fn_log_out}")
+
+    def test_merged_report(self):
+        """Merge logs of a date range into one report."""
+        logs = collect_logs([self.config["LOG_DIR"]])
+        first, last = logs[1][1], logs[-2][1]
+        config = dict(self.config, LOGS=[self.config["LOG_DIR"]],
+                      DATE_START=str(first), DATE_END=str(last), WORKERS=2,
+                      WINDOW=60)
+        self.assertEqual(collect_logs(config["LOGS"], first, last),
+                         [log for log in logs if first <= log[1] <= last])
+        # Same files reached through other spellings are not doubled
+        log_dir = self.config["LOG_DIR"]
+        self.assertEqual(collect_logs([log_dir, log_dir.lstrip("./"),
+                                       os.path.join(log_dir, "*.gz")]),
+                         logs)
+        with self.assertLogs(level="WARNING") as warnings:
+            build_report(config)
+        self.assertTrue(any("WINDOW" in line for line in warnings.output))
+
+        fn_out = os.path.join(self.config["REPORT_DIR"],
+                              f"report-{first}_{last}.html")
+        self.assertTrue(os.path.exists(fn_out))
+        os.system(f"rm {fn_out}")
+
+    def test_merged_report_broken_log(self):
+        """Log that fails to parse is skipped, not fatal to the merge."""
+        logs = collect_logs([self.config["LOG_DIR"]])
+        first, last = logs[0][1], logs[-1][1]
+        broken_dir = "./test_data/broken_log"
+        os.makedirs(broken_dir, exist_ok=True)
+        with open(os.path.join(broken_dir, "nginx-access-ui.log-"
+                               f"{first:%Y%m%d}.gz"), "wb") as f:
+            f.write(b"not a gzip file")
+        config = dict(self.config, LOGS=[self.config["LOG_DIR"], broken_dir],
+                      DATE_START=str(first), DATE_END=str(last), WORKERS=2)
+        try:
+            build_report(config)
+            fn_out = os.path.join(self.config["REPORT_DIR"],
+                                  f"report-{first}_{last}.html")
+            self.assertTrue(os.path.exists(fn_out))
+            os.system(f"rm {fn_out}")
+        finally:
+            os.system(f"rm -r {broken_dir}")
+
+    def test_columnar_report(self):
+        """Columnar copy of the log gives the same stats as raw log."""
+        path, dt = select_recent_log(self.config["LOG_DIR"])
+        col_dir = "./test_data/columnar"
+        config = dict(self.config, COLUMNAR_DIR=col_dir, WINDOW=300)
+        build_report(config)
+
+        col_files = os.listdir(col_dir)
+        self.assertEqual(len(col_files), 1)
+        col_path = os.path.join(col_dir, col_files[0])
+        fn_out = os.path.join(self.config["REPORT_DIR"],
+                              f"report-{dt}.html")
+        self.assertTrue(os.path.exists(fn_out))
+        with open(fn_out) as f:
+            self.assertIn('"peak": {"start"', f.read())
+
+        n_limit = 10**6
+        raw_stats = analyze_log([r for r in iter_log(path) if r], n_limit)
+        col_stats = analyze_columnar(load_columnar(col_path), n_limit)
+        col_stats = {r["url"]: r for r in col_stats}
+        self.assertEqual(len(raw_stats), len(col_stats))
+        for raw in raw_stats:
+            col = col_stats[raw["url"]]
+            self.assertEqual(raw["count"], col["count"])
+            self.assertAlmostEqual(raw["time_sum"], col["time_sum"], 2)
+
+        # Columnar file of the other format version is converted again
+        with open(col_path, "r+b") as f:
+            f.write(b"LACOL\x00\x01\x00")
+        os.remove(fn_out)
+        build_report(config)
+        self.assertTrue(os.path.exists(fn_out))
+        self.assertEqual(len(analyze_columnar(load_columnar(col_path),
+                                              n_limit)), len(raw_stats))
+
+        # Same-named log of another host gets its own columnar file,
+        # log replaced by an older copy is converted again
+        other_dir = "./test_data/other_host"
+        other_path = os.path.join(other_dir, os.path.basename(path))
+        os.makedirs(other_dir)
+        logs = list_logs(self.config["LOG_DIR"])
+        opener = {True: gzip.open, False: open}
+        for src, _ in [log for log in logs if log[0] != path][:2]:
+            with opener[src.endswith(".gz")](src, "rb") as f_src, \
+                    opener[path.endswith(".gz")](other_path, "wb") as f_dst:
+                shutil.copyfileobj(f_src, f_dst)
+            os.utime(other_path, (0, 0))
+            os.remove(fn_out)
+            build_report(dict(config, LOG_DIR=other_dir))
+            self.assertEqual(len(os.listdir(col_dir)), 2)
+            other_col = [os.path.join(col_dir, fn)
+                         for fn in os.listdir(col_dir)
+                         if fn != col_files[0]][0]
+            self.assertEqual(load_columnar(other_col)["records"],
+                             sum(1 for _ in iter_log(other_path)))
+        os.system(f"rm -r {col_dir} {other_dir}; rm {fn_out}")
+
+    def test_report_sinks(self):
+        """Stats are written to every configured sink."""
+        path, dt = select_recent_log(self.config["LOG_DIR"])
+        db_path = os.path.join(self.config["REPORT_DIR"], "stats.sqlite")
+        config = dict(self.config, SQLITE_PATH=db_path,
+                      REPORT_SINKS=["html", "ndjson", "csv", "sqlite"])
+        build_report(config)
+        build_report(config)
+
+        fn_ndjson = os.path.join(self.config["REPORT_DIR"],
+                                 f"report-{dt}.ndjson")
+        with open(fn_ndjson) as f:
+            stats = [json.loads(line) for line in f]
+        db = sqlite3.connect(db_path)
+        n_rows, n_count = db.execute("SELECT COUNT(*), SUM(count) "
+                                     "FROM url_stats").fetchone()
+        db.close()
+        # Second report of the same date replaces rows of the first one
+        self.assertEqual(n_rows, len(stats))
+        self.assertEqual(n_count, sum(rec["count"] for rec in stats))
+
+        for ext in ["html", "ndjson", "csv"]:
+            fn_out = os.path.join(self.config["REPORT_DIR"],
+                                  f"report-{dt}.{ext}")
+            self.assertTrue(os.path.exists(fn_out))
+            os.remove(fn_out)
+        os.remove(db_path)
+
+        # Unknown sink is reported before anything is written
+        with self.assertRaises(ValueError):
+            write_report([], dict(config, REPORT_SINKS=["html", "bogus"]),
+                         dt)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.config["REPORT_DIR"], f"report-{dt}.html")))
+
+
+    def test_max_urls_report(self):
+        """Report with MAX_URLS is built from bounded aggregates."""
+        path, dt = select_recent_log(self.config["LOG_DIR"])
+        config = dict(self.config, MAX_URLS=5, REPORT_SINKS=["ndjson"])
+        with self.assertLogs(level="WARNING") as logs:
+            build_report(config)
+        self.assertTrue(any(OTHER_URL in line for line in logs.output))
+        fn_out = os.path.join(self.config["REPORT_DIR"],
+                              f"report-{dt}.ndjson")
+        with open(fn_out) as f:
+            urls = [json.loads(line)["url"] for line in f]
+        os.remove(fn_out)
+        self.assertEqual(len(urls), 6)
+        self.assertIn(OTHER_URL, urls)
+
+class TestUrlNormalization(unittest.TestCase):
+    def test_normalize_url(self):
+        """Query params and id-like path segments are normalized."""
+        url = "/api/v2/banner/25019354/?b=2&a=1"
+        uuid = "/group/1b7a3c9e-0c2a-4f7e-9d6b-3f1e2a4c5d6e/stats"
+        rules = compile_url_rules({"URL_QUERY": "sort"})
+        self.assertEqual(normalize_url(url, rules),
+                         "/api/v2/banner/25019354/?a=1&b=2")
+        rules = compile_url_rules({"URL_QUERY": "drop",
+                                   "URL_PLACEHOLDERS": True})
+        self.assertEqual(normalize_url(url, rules), "/api/v2/banner/{id}/")
+        self.assertEqual(normalize_url(uuid, rules), "/group/{uuid}/stats")
+        rules = compile_url_rules({"URL_REWRITES": [[r"^/api/v\d+", "/api"]]})
+        self.assertEqual(normalize_url(url, rules),
+                         "/api/banner/25019354/?b=2&a=1")
+
+    def test_max_urls(self):
+        """URLs beyond the cap are accounted to the "other" bucket."""
+        data = [{"request": f"/url/{i}", "request_time": 1.0}
+                for i in range(10)]
+        stats = analyze_log(data, n_limit=100, max_urls=3)
+        self.assertEqual(len(stats), 4)
+        other = [rec for rec in stats if rec["url"] == OTHER_URL][0]
+        self.assertEqual(other["count"], 7)
+        self.assertAlmostEqual(sum(rec["count_perc"] for rec in stats), 1)
+
+    def test_max_urls_heavy_hitter(self):
+        """Expensive URL first seen after the cap is full is kept."""
+        data = [{"request": f"/url/{i % 50}", "request_time": 0.1}
+                for i in range(500)]
+        data.append({"request": "/slow", "request_time": 100.0})
+        for stats in (analyze_log(data, n_limit=3, max_urls=5),
+                      stats_from_aggregates(
+                          aggregate_records(data, max_urls=5), 3)):
+            self.assertEqual([rec["url"] for rec in stats[-2:]],
+                             [OTHER_URL, "/slow"])
+            self.assertEqual(stats[-1]["time_sum"], 100.0)
+
+class TestWindows(unittest.TestCase):
+    def test_parse_time_local(self):
+        """Cached parser agrees with strptime."""
+        for s in ["[29/Jun/2017:03:50:22 +0300]",
+                  "[29/Jun/2017:23:59:59 +0300]",
+                  "[01/Jan/2018:00:00:00 -0700]"]:
+            expected = datetime.strptime(s, "[%d/%b/%Y:%H:%M:%S %z]")
+            self.assertEqual(parse_time_local(s), expected.timestamp())
+
+    def test_aggregate_windows(self):
+        """Requests are split into windows, the busiest one is the peak."""
+        requests = [(0, "/a", 0.1), (30, "/b", 0.2), (61, "/a", 0.3),
+                    (62, "/a", 0.4), (125, "/b", 0.5), (5, "/a", 0.6)]
+        windows = aggregate_windows(requests, 60, max_windows=2)
+        self.assertEqual([w["count"] for w in windows["windows"]],
+                         [2, 2, 1])
+        self.assertEqual(windows["peak"]["start"],
+                         "1970-01-01T00:00:00+00:00")
+        # Window of the last request was already closed
+        self.assertEqual(windows["late"], 1)
+        self.assertEqual(windows["windows"][1]["urls"][0]["url"], "/a")
+
+
+class TestLogDaemon(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.config = {
+            "REPORT_SIZE": 1000,
+            "LOG_DIR": "./test_data/daemon_log",
+            "CACHE_DIR": "./test_data/cache",
+            "ERROR_RATE_THRESHOLD": 0.7,
+            "DAEMON_WORKERS": 2
+        }
+        copy_fixture_logs(cls.config["LOG_DIR"], 3)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.system(f"rm -r {cls.config['LOG_DIR']}")
+        os.system(f"rm -r {cls.config['CACHE_DIR']}")
+
+    def test_ingest_and_query(self):
+        """Daemon should ingest all logs and answer queries from cache."""
+        daemon = LogDaemon(self.config)
+        asyncio.run(daemon.ingest())
+        daemon.pool.shutdown()
+        days = sorted(str(dt) for _, dt in list_logs(self.config["LOG_DIR"]))
+
+        status, body = daemon.query("/dates")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, sorted(set(days)))
+
+        status, top = daemon.query(f"/top?date={days[0]}&n=5")
+        self.assertEqual(status, 200)
+        self.assertLessEqual(len(top), 5)
+        times = [rec["time_sum"] for rec in top]
+        self.assertEqual(times, sorted(times, reverse=True))
+
+        url = quote(top[0]["url"])
+        status, body = daemon.query(f"/url?date={days[0]}&url={url}")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["count"], top[0]["count"])
+
+        status, _ = daemon.query("/top?date=notadate")
+        self.assertEqual(status, 400)
+
+        # New daemon restores aggregates without reparsing
+        restored = LogDaemon(self.config)
+        restored.pool.shutdown()
+        self.assertEqual(restored.query(f"/top?date={days[0]}&n=5"),
+                         (200, top))
+
+    def test_failed_log_retried(self):
+        """Log that failed to parse is not marked as ingested."""
+        config = dict(self.config, LOG_DIR="./test_data/daemon_broken",
+                      CACHE_DIR="./test_data/cache_broken")
+        os.makedirs(config["LOG_DIR"], exist_ok=True)
+        path = os.path.join(config["LOG_DIR"],
+                            "nginx-access-ui.log-20170701.gz")
+        with open(path, "wb") as f:
+            f.write(b"not a gzip file")
+        try:
+            daemon = LogDaemon(config)
+            asyncio.run(daemon.ingest())
+            daemon.pool.shutdown()
+            self.assertNotIn(path, daemon.ingested)
+            self.assertEqual(daemon.query("/dates"), (200, []))
+        finally:
+            os.system(f"rm -r {config['LOG_DIR']} {config['CACHE_DIR']}")
+
+    def test_broken_pool_and_cache(self):
+        """Daemon recovers from dead workers and a corrupt cache."""
+        config = dict(self.config, CACHE_DIR="./test_data/cache_corrupt")
+        os.makedirs(config["CACHE_DIR"], exist_ok=True)
+        with open(os.path.join(config["CACHE_DIR"], "aggregates.json"),
+                  "w") as f:
+            f.write('{"ingested": ["trunc')
+        try:
+            daemon = LogDaemon(config)
+            self.assertEqual(daemon.days, {})
+            # Worker dies, e.g. killed by OOM, and breaks the pool
+            with self.assertRaises(BrokenProcessPool):
+                daemon.pool.submit(os._exit, 1).result()
+            asyncio.run(daemon.ingest())
+            daemon.pool.shutdown()
+            self.assertEqual(len(daemon.ingested), 3)
+        finally:
+            os.system(f"rm -r {config['CACHE_DIR']}")
+
+
+class TestStartup(unittest.TestCase):
+    """Startup and end-to-end timings of the CLI, printed to stderr."""
+
+    def run_python(self, *args):
+        t = time.perf_counter()
+        proc = subprocess.run([sys.executable, *args], capture_output=True,
+                              text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return time.perf_counter() - t, proc.stdout
+
+    def test_lazy_imports(self):
+        """Heavy modules are not imported until needed."""
+        _, out = self.run_python("-c", "import sys, log_analyzer; "
+                                       "print(' '.join(sys.modules))")
+        for module in ["gzip", "mmap", "tempfile", "concurrent.futures",
+                       "multiprocessing", "asyncio"]:
+            self.assertNotIn(module, out.split())
+
+    def test_startup_time(self):
+        """Import of log_analyzer on top of bare interpreter start."""
+        bare = min(self.run_python("-c", "pass")[0] for _ in range(5))
+        full = min(self.run_python("-c", "import log_analyzer")[0]
+                   for _ in range(5))
+        sys.stderr.write(f"\nstartup: interpreter {bare * 1000:.1f} ms, "
+                         f"import log_analyzer +{(full - bare) * 1000:.1f} "
+                         f"ms\n")
+        self.assertLess(full - bare, 0.5)
+
+    def test_end_to_end_time(self):
+        """Whole CLI run over a single log."""
+        config = {"LOG_DIR": "./test_data/startup_log",
+                  "REPORT_DIR": "./test_data/startup_reports",
+                  "LOG": ""}
+        copy_fixture_logs(config["LOG_DIR"], 1)
+        config_path = "./test_data/startup_config.json"
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+
+        elapsed, _ = self.run_python("log_analyzer.py", "--config",
+                                     config_path)
+        sys.stderr.write(f"\nend-to-end: {elapsed * 1000:.1f} ms\n")
+        self.assertEqual(len(os.listdir(config["REPORT_DIR"])), 1)
+        shutil.rmtree(config["LOG_DIR"])
+        shutil.rmtree(config["REPORT_DIR"])
+        os.remove(config_path)
@@ -2,6 +2,8 @@ import os
 import random
 import gzip
 import argparse
+from collections import Counter
+from itertools import islice
 
 
 def create_smaller_log(fn_from, fn_to, n):
@@ -15,49 +17,60 @@ def create_smaller_log(fn_from, fn_to, n):
         fn_to (str): out path in .gz format.
         n (int): number of reconds to sample to out log.
     """
-    lines = []
-    with gzip.open(fn_from, 'rb') as f:
-        for i, line in enumerate(f.readlines()[:n]):
-            lines.append(line)
-    with gzip.open(fn_to, 'wb') as f:
-        f.writelines(lines)
+    with gzip.open(fn_from, 'rb') as f_from, gzip.open(fn_to, 'wb') as f_to:
+        f_to.writelines(islice(f_from, n))
 
 
 def generate_logs(fn_from, dest_dir, n_logs=10):
     """Create multiple logs sample from some file.
 
+    Source log is streamed twice (to count lines and to copy
+    sampled ones to all logs at once), it is never loaded into memory.
+    Sampled lines keep their order in the source log. Every log gets
+    its own date.
+
     Args:
         fn_from (str): log .gz file to sample from.
-         ource_dir (str): directory to put logs to.
+        dest_dir (str): directory to put logs to.
         n_logs (int): number of logs to generate.
     """
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
     with gzip.open(fn_from, 'rb') as f:
-        lines = f.readlines()
-
-    # Convert binary object to strings
-    lines = list(map(lambda x: x.decode('utf-8'), lines))
-
-    for _ in range(n_logs):
-        n = random.randrange(100, 10_000)
-        inds = [random.randrange(len(lines)) for _ in range(n)]
-        lines_samples = [lines[i] for i in inds]
+        n_lines = sum(1 for _ in f)
 
+    samples = []
+    dates = set()
+    while len(samples) < n_logs:
         ry = random.randint(2000, 2020)
         rm = random.randint(1, 12)
         rd = random.randint(1, 29)
+        # Same date would open one file twice and mix writes of both
+        if (ry, rm, rd) in dates:
+            continue
+        dates.add((ry, rm, rd))
+
+        n = random.randrange(100, 10_000)
+        inds = Counter(random.randrange(n_lines) for _ in range(n))
         gz_format = random.randrange(2)
 
         if gz_format:
             fn = f"nginx-access.log-{ry}{rm:02d}{rd:02d}.gz"
-            with gzip.open(os.path.join(dest_dir, fn), 'wb') as f:
-                for line in lines_samples:
-                    f.write(line.encode())
+            f = gzip.open(os.path.join(dest_dir, fn), 'wb')
         else:
             fn = f"nginx-access.log-{ry}{rm:02d}{rd:02d}.log"
-            with open(os.path.join(dest_dir, fn), 'w') as f:
-                f.writelines(lines_samples)
+            f = open(os.path.join(dest_dir, fn), 'wb')
+        samples.append((inds, f))
+
+    try:
+        with gzip.open(fn_from, 'rb') as f_from:
+            for i, line in enumerate(f_from):
+                for inds, f in samples:
+                    if i in inds:
+                        f.write(line * inds[i])
+    finally:
+        for _, f in samples:
+            f.close()
 
 
 if __name__ == "__main__":
@@ -20,28 +20,84 @@
 # -----------------
 
 from itertools import product, combinations
-from collections import Counter
+
+
+RANK_VALUES = {r: i for i, r in enumerate("23456789TJQKA", 2)}
+SUIT_BITS = {"C": 1, "S": 2, "H": 4, "D": 8}
+
+
+def _straight_high(mask):
+    """Highest rank of a straight in 13-bit rank mask (bit 0 is
+    rank 2), 0 if there is no straight. Ace also plays as 1. """
+    for high in range(14, 5, -1):
+        run = 0b11111 << (high - 6)
+        if mask & run == run:
+            return high
+    wheel = 0b1000000001111
+    return 5 if mask & wheel == wheel else 0
+
+
+def _mask_ranks(mask):
+    """Ranks present in 13-bit rank mask from larger to smaller. """
+    return tuple(r for r in range(14, 1, -1) if mask >> (r - 2) & 1)
+
+
+# Lookup tables indexed by 13-bit rank mask
+STRAIGHT_HIGH = [_straight_high(m) for m in range(1 << 13)]
+MASK_RANKS = [_mask_ranks(m) for m in range(1 << 13)]
+HIGH_RANK = [r[0] if r else 0 for r in MASK_RANKS]
+
+
+def rank_profile(ranks):
+    """Returns rank mask and count masks of ranks.
+
+    Rank mask has bit r-2 set for every rank r present, count mask n
+    (index in the returned list) has bits of ranks repeated n times. """
+    counts = [0] * 15
+    for r in ranks:
+        counts[r] += 1
+    rank_mask = 0
+    by_count = [0] * 8
+    for r in ranks:
+        bit = 1 << (r - 2)
+        if not rank_mask & bit:
+            rank_mask |= bit
+            by_count[counts[r]] |= bit
+    return rank_mask, by_count
+
+
+def hand_profile(hand):
+    """Returns shared representation of the hand built once:
+    ranks sorted from larger to smaller, rank mask, count masks
+    (see `rank_profile`) and mask of suits. """
+    ranks = card_ranks(hand)
+    suit_mask = 0
+    for c in hand:
+        suit_mask |= SUIT_BITS[get_suite(c)]
+    return (ranks, *rank_profile(ranks), suit_mask)
 
 
 def hand_rank(hand):
     """Returns numeric value of the hand. """
-    ranks = card_ranks(hand)
-    if straight(ranks) and flush(hand):
-        return (8, max(ranks))
-    elif kind(4, ranks):
-        return (7, kind(4, ranks), kind(1, ranks))
-    elif kind(3, ranks) and kind(2, ranks):
-        return (6, kind(3, ranks), kind(2, ranks))
-    elif flush(hand):
+    ranks, rank_mask, by_count, suit_mask = hand_profile(hand)
+    high = STRAIGHT_HIGH[rank_mask]
+    is_flush = suit_mask & (suit_mask - 1) == 0
+    if high and is_flush:
+        return (8, high)
+    elif by_count[4]:
+        return (7, HIGH_RANK[by_count[4]], HIGH_RANK[by_count[1]])
+    elif by_count[3] and by_count[2]:
+        return (6, HIGH_RANK[by_count[3]], HIGH_RANK[by_count[2]])
+    elif is_flush:
         return (5, ranks)
-    elif straight(ranks):
-        return (4, max(ranks))
-    elif kind(3, ranks):
-        return (3, kind(3, ranks), ranks)
-    elif two_pair(ranks):
-        return (2, two_pair(ranks), ranks)
-    elif kind(2, ranks):
-        return (1, kind(2, ranks), ranks)
+    elif high:
+        return (4, high)
+    elif by_count[3]:
+        return (3, HIGH_RANK[by_count[3]], ranks)
+    elif len(MASK_RANKS[by_count[2]]) >= 2:
+        return (2, MASK_RANKS[by_count[2]], ranks)
+    elif by_count[2]:
+        return (1, HIGH_RANK[by_count[2]], ranks)
     else:
         return (0, ranks)
 
@@ -53,11 +109,7 @@ def get_suite(card):
 
 def get_rank(card):
     """Get numeric value of the card. """
-    r = card[0]
-    d = {"T": 10, "J": 11, "Q": 12, "K": 13, "A": 14}
-    if r in "TJQKA":
-        return d[r]
-    return int(r)
+    return RANK_VALUES[card[0]]
 
 
 def card_ranks(hand):
@@ -72,56 +124,35 @@ def flush(hand):
     return sum([get_suite(c) == suite for c in hand]) == len(hand)
 
 
-def straight(ranks, k=5):
-    """Returns True if sorted ranks form a sequence of 5 cards,
-    where ranks are in natural order (street). """
-    def pair(c1, c2):
-        if (c2 - c1) == 1:
-            return '1'
-        return '0'
-
-    neighbours = ''.join([pair(ranks[i], ranks[i+1])
-                         for i in range(len(ranks)-1)])
-    return neighbours.find("1"*k) != -1
+def straight(ranks):
+    """Returns True if ranks contain 5 distinct ranks in natural
+    order (street), ace can also start the street A-2-3-4-5. """
+    rank_mask = 0
+    for r in ranks:
+        rank_mask |= 1 << (r - 2)
+    return STRAIGHT_HIGH[rank_mask] != 0
 
 
 def kind(n, ranks):
     """Returns the first rank that encountered in hand for n times.
-    Returns None, if no such repeats exist."""
-    cnt = Counter(ranks)
-    best_rank = 0
-    for k, v in cnt.items():
-        if v == n and k > best_rank:
-            best_rank = k
-    return best_rank
+    Returns 0, if no such repeats exist."""
+    return HIGH_RANK[rank_profile(ranks)[1][n]]
 
 
 def two_pair(ranks):
-    """Return True if two pairs exists, None othewise. """
-    cnt_ranks = Counter(ranks)
-    cnt_repeats = Counter(cnt_ranks.values())
-    if not (2 in cnt_repeats.keys()):
+    """Return ranks of pairs from larger to smaller if two pairs
+    exist, None othewise. """
+    pairs = MASK_RANKS[rank_profile(ranks)[1][2]]
+    if len(pairs) < 2:
         return None
-    return [r for r in cnt_ranks if cnt_ranks[r] == 2]
+    return pairs
 
 
 def compare_rank_info(info, best_rank):
     """Returns True if info is better than best_rank. """
     if best_rank is None:
         return True
-    # If got two flushes pick one with straight property
-    if info[0] == best_rank[0] == 5:
-        return straight(info[1], 4) and not straight(best_rank[1], 4)
-    elif info[0] == best_rank[0] == 6:
-        if info[1] > best_rank[1]:
-            return True
-        elif info[1] == best_rank[1]:
-            return info[2] > best_rank[2]
-    # In case of Kind select one with the highest ranks
-    elif info[0] == best_rank[0] == 7:
-        if sum(info[1:]) > sum(best_rank[1:]):
-            return True
-    return info[0] > best_rank[0]
+    return info > best_rank
 
 
 def best_hand(hand):
@@ -141,7 +172,7 @@ def hand_options(hand, joker):
     if joker not in hand:
         return []
     ranks = list(map(str, range(2, 10))) + ['T', 'J', 'Q', 'K', 'A']
-    suites = ['C', 'S'] if joker == '?B' else ['H', 'W']
+    suites = ['C', 'S'] if joker == '?B' else ['H', 'D']
     joker_replacements = map(lambda x: ''.join(x), product(ranks, suites))
     hands = []
     for wildcard in joker_replacements:
@@ -193,7 +224,7 @@ def test_best_hand():
 def test_best_wild_hand():
     print("test_best_wild_hand...")
     assert (sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split()))
-            == ['6C', '7C', '8C', '9C', 'TC'])
+            == ['7C', '8C', '9C', 'JC', 'TC'])
     assert (sorted(best_wild_hand("TD TC 5H 5C 7C ?R ?B".split()))
             == ['7C', 'TC', 'TD', 'TH', 'TS'])
     assert (sorted(best_wild_hand("JD TC TH 7C 7D 7S 7H".split()))
@@ -201,6 +232,22 @@ def test_best_wild_hand():
     print('OK')
 
 
+def test_hand_rank():
+    print("test_hand_rank...")
+    assert straight([9, 8, 7, 7, 6, 5])
+    assert straight([14, 5, 4, 3, 2])
+    assert not straight([14, 13, 12, 11, 9])
+    assert kind(2, [9, 9, 7, 7, 5]) == 9 and kind(3, [9, 9, 7, 7, 5]) == 0
+    assert two_pair([9, 9, 7, 7, 5]) == (9, 7)
+    assert hand_rank("AS 2S 3S 4S 5S".split()) == (8, 5)
+    assert hand_rank("AS 2H 3S 4D 5C".split()) == (4, 5)
+    assert hand_rank("9S 9H 7S 7D 5C".split()) == (2, (9, 7), [9, 9, 7, 7, 5])
+    assert (sorted(best_hand("AH 2C 3S 4D 5C KD KH".split()))
+            == ['2C', '3S', '4D', '5C', 'AH'])
+    print('OK')
+
+
 if __name__ == '__main__':
+    test_hand_rank()
     test_best_hand()
     test_best_wild_hand()
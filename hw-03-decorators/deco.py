@@ -1,3 +1,37 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import partial, update_wrapper, wraps
+from itertools import islice
+from time import perf_counter_ns
+from types import CodeType
+from timeit import timeit
+from weakref import WeakKeyDictionary
+
+
+# Plain countcalls/memo wrappers mapped to (kind, func, state) so that
+# stacking one over the other builds a single fused wrapper
+_fusable = WeakKeyDictionary()
+
+# Per-function lists of per-thread profile records, filled by `profile`
+profiles = {}
+# Latency histogram buckets: bit lengths of 64-bit ns timings,
+# followed in profile records by total, min and max time
+HIST_SIZE = 65
+TOTAL, MIN, MAX = HIST_SIZE, HIST_SIZE + 1, HIST_SIZE + 2
 
 
 def disable(func):
@@ -17,25 +51,63 @@ def decorator(func):
     '''
     Decorate a decorator so that it inherits the docstrings
     and stuff from the function it's decorating.
+
+    Metadata (__name__, __doc__, __wrapped__, attributes like `calls`)
+    is copied once, when the decorator is applied, never per call.
+    Called with keyword options only, the decorator returns a factory:
+    `@n_ary(associative=True)` is the same as `n_ary(f, associative=True)`.
     '''
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        wrapped = args[0]
-        for attr in wrapped.__dict__:
-            setattr(wrapper, attr, wrapped.__dict__[attr])
+        if not args and kwargs:
+            return lambda wrapped: wrapper(wrapped, **kwargs)
         res = func(*args, **kwargs)
+        wrapped = args[0]
+        if res is not wrapped:
+            update_wrapper(res, wrapped, updated=())
+            for attr, val in wrapped.__dict__.items():
+                if attr not in res.__dict__:
+                    setattr(res, attr, val)
         return res
     return wrapper
 
 
+_kwargs_mark = object()
+
+
+def _make_key(args, kwargs):
+    '''Hashable cache key for call arguments. '''
+    if not kwargs:
+        return args
+    return args + (_kwargs_mark,) + tuple(sorted(kwargs.items()))
+
+
 @decorator
 def countcalls(func):
     '''Decorator that counts calls made to the function decorated.'''
-    def wrapper(*args, **kwargs):
-        wrapper.calls['n'] += 1
-        res = func(*args, **kwargs)
-        return res
+    calls = {'n': 0}
+    parts = _fusable.get(func)
+    if parts is not None and parts[0] == 'memo':
+        # countcalls over memo: count every call, hits included,
+        # in the same frame as the cache lookup
+        _, inner, cache = parts
+
+        def wrapper(*args, **kwargs):
+            calls['n'] += 1
+            lookup = _make_key(args, kwargs)
+            if lookup in cache:
+                print(f"Returning memoized value for {args}, {kwargs}")
+                return cache[lookup]
+            res = cache[lookup] = inner(*args, **kwargs)
+            return res
+    else:
+        def wrapper(*args, **kwargs):
+            calls['n'] += 1
+            return func(*args, **kwargs)
+
+        _fusable[wrapper] = ('countcalls', func, calls)
 
-    wrapper.calls = {'n': 0}
+    wrapper.calls = calls
     return wrapper
 
 
@@ -44,38 +116,301 @@ def memo(func):
     ''' Memoize a function so that it caches all
     return values for faster future lookups.  '''
     cache = {}
+    parts = _fusable.get(func)
+    if parts is not None and parts[0] == 'countcalls':
+        # memo over countcalls: count only cache misses,
+        # in the same frame as the cache lookup
+        _, inner, calls = parts
 
-    def wrapper(*args, **kwargs):
-        lookup = tuple(list(args) +
-                       [f"{k}{kwargs[k]}" for k in sorted(kwargs)])
-        if tuple(args) in cache:
-            print(f"Returning memoized value for {args}, {kwargs}")
-            return cache[lookup]
-        res = func(*args, **kwargs)
-        cache[lookup] = res
-        return res
+        def wrapper(*args, **kwargs):
+            lookup = _make_key(args, kwargs)
+            if lookup in cache:
+                print(f"Returning memoized value for {args}, {kwargs}")
+                return cache[lookup]
+            calls['n'] += 1
+            res = cache[lookup] = inner(*args, **kwargs)
+            return res
+    else:
+        def wrapper(*args, **kwargs):
+            lookup = _make_key(args, kwargs)
+            if lookup in cache:
+                print(f"Returning memoized value for {args}, {kwargs}")
+                return cache[lookup]
+            res = cache[lookup] = func(*args, **kwargs)
+            return res
 
-    # transfer all inherited memo's attrs to wrapper
-    for attr in memo.__dict__:
-        setattr(wrapper, attr, memo.__dict__[attr])
+        _fusable[wrapper] = ('memo', func, cache)
 
     return wrapper
 
 
+def async_memo(maxsize=128):
+    '''
+    Memoize a coroutine function with a bounded LRU cache.
+
+    Awaited results are cached, at most `maxsize` of them are kept
+    (least recently used ones are evicted first). Concurrent callers
+    with the same arguments share one in-flight future instead of
+    starting duplicate calls; the call keeps running and its result is
+    cached even if the caller that started it is cancelled. Failed
+    calls are not cached.
+    Plain functions get the same bounded cache and stats.
+
+    >>> @async_memo(maxsize=2)
+    ... async def lookup(key):
+    ...     ...
+    >>> lookup.stats
+    {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    '''
+    def decorator(func):
+        cache = OrderedDict()
+        in_flight = {}
+
+        def store(lookup, res):
+            cache[lookup] = res
+            if len(cache) > maxsize:
+                cache.popitem(last=False)
+                wrapper.stats['evictions'] += 1
+
+        def sync_wrapper(*args, **kwargs):
+            lookup = _make_key(args, kwargs)
+            if lookup in cache:
+                wrapper.stats['hits'] += 1
+                cache.move_to_end(lookup)
+                return cache[lookup]
+            wrapper.stats['misses'] += 1
+            res = func(*args, **kwargs)
+            store(lookup, res)
+            return res
+
+        def done(lookup, future):
+            # The future, not its first caller, owns the bookkeeping:
+            # a cancelled caller neither drops the in-flight entry nor
+            # loses the result for the callers that come after it
+            in_flight.pop(lookup, None)
+            if not future.cancelled() and future.exception() is None:
+                store(lookup, future.result())
+
+        async def async_wrapper(*args, **kwargs):
+            lookup = _make_key(args, kwargs)
+            if lookup in cache:
+                wrapper.stats['hits'] += 1
+                cache.move_to_end(lookup)
+                return cache[lookup]
+            if lookup in in_flight:
+                wrapper.stats['coalesced'] += 1
+                return await asyncio.shield(in_flight[lookup])
+
+            wrapper.stats['misses'] += 1
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            in_flight[lookup] = future
+            future.add_done_callback(partial(done, lookup))
+            return await asyncio.shield(future)
+
+        if inspect.iscoroutinefunction(func):
+            wrapper = async_wrapper
+        else:
+            wrapper = sync_wrapper
+
+        def cache_clear():
+            cache.clear()
+            for k in wrapper.stats:
+                wrapper.stats[k] = 0
+
+        wrapper.stats = {'hits': 0, 'misses': 0,
+                         'coalesced': 0, 'evictions': 0}
+        wrapper.cache_clear = cache_clear
+        return update_wrapper(wrapper, func)
+    return decorator
+
+
+def _code_digest(code, digest):
+    '''Feed stable parts of a code object into digest: bytecode,
+    names and constants, nested code objects (lambdas, comprehensions,
+    inner functions) are walked instead of taking their repr, which
+    contains a memory address. '''
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _code_digest(const, digest)
+        else:
+            digest.update(repr(_canonical(const)).encode())
+
+
+def _canonical(obj):
+    '''Replace sets in obj with sorted tuples, so that pickling and
+    repr do not depend on the hash randomization of the process. '''
+    if isinstance(obj, (set, frozenset)):
+        return (type(obj).__name__,
+                tuple(sorted((_canonical(x) for x in obj), key=repr)))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_canonical(x) for x in obj)
+    if isinstance(obj, dict):
+        return {k: _canonical(v) for k, v in obj.items()}
+    return obj
+
+
+def disk_memo(path="deco_cache.sqlite", maxsize=10_000, version=""):
+    '''
+    Memoize a function in a sqlite file so that results survive
+    restarts and are shared between processes.
+
+    Keys are sha256 hashes of the pickled arguments prefixed with the
+    function fingerprint (module, name, bytecode, constants and
+    `version`), so changing the function body or bumping `version`
+    invalidates old entries. At most `maxsize` entries per function
+    are kept, least recently used ones are evicted first.
+
+    Sets in arguments (also nested in lists, tuples and dicts) are
+    sorted before hashing. Other objects whose pickle depends on
+    hash randomization (e.g. custom classes holding sets) produce
+    different keys in different processes and never hit the cache.
+
+    @disk_memo("cache.sqlite", maxsize=1000, version="2")
+    def analyze(path):
+        ....
+
+    '''
+    def decorator(func):
+        digest = hashlib.sha256()
+        digest.update(f"{func.__module__}.{func.__qualname__}:{version}"
+                      .encode())
+        _code_digest(func.__code__, digest)
+        fingerprint = digest.hexdigest()
+        local = threading.local()
+
+        def connect():
+            # sqlite connections can not be shared across threads
+            # and fork(), so there is one per thread of each process
+            if getattr(local, 'pid', None) != os.getpid():
+                db = sqlite3.connect(path, timeout=30,
+                                     isolation_level=None)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS memo ("
+                           "key TEXT PRIMARY KEY, func TEXT, "
+                           "value BLOB, accessed REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS memo_func_accessed "
+                           "ON memo (func, accessed)")
+                local.pid, local.db = os.getpid(), db
+            return local.db
+
+        def wrapper(*args, **kwargs):
+            lookup = _canonical((args, sorted(kwargs.items())))
+            key = fingerprint + hashlib.sha256(
+                pickle.dumps(lookup)).hexdigest()
+            db = connect()
+            row = db.execute("SELECT value FROM memo WHERE key = ?",
+                             (key,)).fetchone()
+            if row is not None:
+                wrapper.stats['hits'] += 1
+                db.execute("UPDATE memo SET accessed = ? WHERE key = ?",
+                           (time.time(), key))
+                return pickle.loads(row[0])
+
+            wrapper.stats['misses'] += 1
+            res = func(*args, **kwargs)
+            value = pickle.dumps(res)
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)",
+                           (key, fingerprint, value, time.time()))
+                db.execute("DELETE FROM memo WHERE key IN ("
+                           "SELECT key FROM memo WHERE func = ? "
+                           "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                           (fingerprint, maxsize))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            return res
+
+        def cache_clear():
+            connect().execute("DELETE FROM memo WHERE func = ?",
+                              (fingerprint,))
+
+        wrapper.stats = {'hits': 0, 'misses': 0}
+        wrapper.cache_clear = cache_clear
+        return update_wrapper(wrapper, func)
+    return decorator
+
+
+def _fold_left(func, items):
+    '''Reduce items with binary func from the left. '''
+    items = iter(items)
+    try:
+        res = next(items)
+    except StopIteration:
+        raise TypeError("reduce of empty sequence with no initial value")
+    for item in items:
+        res = func(res, item)
+    return res
+
+
+def _fold_right(func, items):
+    '''Reduce items with binary func from the right,
+    f(x, f(y, z)), without recursion. '''
+    items = items if isinstance(items, (list, tuple)) else list(items)
+    if not items:
+        raise TypeError("reduce of empty sequence with no initial value")
+    res = items[-1]
+    for i in range(len(items) - 2, -1, -1):
+        res = func(items[i], res)
+    return res
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 @decorator
-def n_ary(func):
+def n_ary(func, associative=False):
     '''
     Given binary function f(x, y), return an n_ary function such
     that f(x, y, z) = f(x, f(y,z)), etc. Also allow f(x) = x.
+
+    Arguments are reduced in a loop, so any number of them is fine.
+    Large inputs can be streamed with `f.reduce(iterable)`. If f is
+    associative (pass associative=True) the input is folded from the
+    left without being materialized, and `f.reduce(iterable, pool)`
+    reduces chunks in parallel with any object providing `map`
+    (ProcessPoolExecutor or multiprocessing.Pool for module-level
+    functions, ThreadPoolExecutor for the rest). The pool gets at most
+    `window` chunks at a time, so the input is still streamed.
+    Like functools.reduce, empty input raises TypeError.
     '''
+    fold = _fold_left if associative else _fold_right
+
     def wrapper(*args, **kwargs):
         if len(args) == 1:
             return args[0]
         elif len(args) == 2:
             return func(*args, **kwargs)
-        else:
-            res = func(args[0], wrapper(*args[1:]))
-            return res
+        if kwargs:
+            return fold(lambda x, y: func(x, y, **kwargs), args)
+        return fold(func, args)
+
+    def reduce(iterable, pool=None, chunksize=1024, window=16):
+        if pool is None or not associative:
+            return fold(func, iterable)
+        # The wrapper, unlike func, is what the module holds under the
+        # function's name, so it can be pickled for process pools
+        fold_chunk = partial(_fold_left, wrapper)
+        chunks = _chunks(iterable, chunksize)
+        res = []
+        while True:
+            batch = list(islice(chunks, window))
+            if not batch:
+                return _fold_left(func, res)
+            res = [_fold_left(func, res + list(pool.map(fold_chunk, batch)))]
+
+    wrapper.reduce = reduce
     return wrapper
 
 
@@ -100,6 +435,7 @@ def trace(fill):
 
     '''
     def decorator(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
             pad = decorator.padding
             print(f"{pad}--> {func.__name__}({args[0]})")
@@ -114,6 +450,135 @@ def trace(fill):
     return decorator
 
 
+def _new_record():
+    return [0] * HIST_SIZE + [0, 1 << 63, 0]
+
+
+def profile(sample_every=0, max_samples=100):
+    '''Profile calls made to function decorated.
+
+    Total and exact min/max time and a log2 histogram of latencies
+    (bucket i holds calls that took [2**(i-1), 2**i) ns) are gathered
+    with perf_counter_ns into per-thread records, so no locking happens
+    on the call path; call count is the histogram sum. Every
+    `sample_every`-th call of a thread also keeps repr of its arguments
+    (0 disables sampling), only the last `max_samples` per thread
+    are kept.
+
+    @profile()
+    def fib(n):
+        ....
+
+    >>> fib(3)
+    >>> print(profile_report())
+    deco.fib: calls=5 total=2.1us min=180ns max=1.1us
+
+    '''
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+        records = profiles.setdefault(name, [])
+        local = threading.local()
+        clock = perf_counter_ns
+        total_i, min_i, max_i = TOTAL, MIN, MAX
+
+        def new_record():
+            rec = local.rec = _new_record()
+            local.samples = deque(maxlen=max_samples)
+            local.calls = 0
+            records.append((rec, local.samples))
+            return rec
+
+        def wrapper(*args, **kwargs):
+            try:
+                rec = local.rec
+            except AttributeError:
+                rec = new_record()
+            t0 = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                dt = clock() - t0
+                rec[dt.bit_length()] += 1
+                rec[total_i] += dt
+                if dt < rec[min_i]:
+                    rec[min_i] = dt
+                if dt > rec[max_i]:
+                    rec[max_i] = dt
+
+        def sampling_wrapper(*args, **kwargs):
+            try:
+                rec = local.rec
+            except AttributeError:
+                rec = new_record()
+            t0 = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                dt = clock() - t0
+                rec[dt.bit_length()] += 1
+                rec[total_i] += dt
+                if dt < rec[min_i]:
+                    rec[min_i] = dt
+                if dt > rec[max_i]:
+                    rec[max_i] = dt
+                local.calls += 1
+                if local.calls % sample_every == 0:
+                    local.samples.append(f"{args!r}, {kwargs!r}")
+
+        if sample_every:
+            return update_wrapper(sampling_wrapper, func)
+        return update_wrapper(wrapper, func)
+    return decorator
+
+
+def profile_stats():
+    '''Merge per-thread records of every profiled function. '''
+    stats = {}
+    for name, records in profiles.items():
+        recs = [rec for rec, _ in records if any(rec[:HIST_SIZE])]
+        if not recs:
+            continue
+        hist = [sum(h) for h in zip(*[rec[:HIST_SIZE] for rec in recs])]
+        stats[name] = {
+            "calls": sum(hist),
+            "total_ns": sum(rec[TOTAL] for rec in recs),
+            "min_ns": min(rec[MIN] for rec in recs),
+            "max_ns": max(rec[MAX] for rec in recs),
+            "histogram": {1 << i: n for i, n in enumerate(hist) if n},
+            "samples": [smp for _, samples in records for smp in samples],
+        }
+    return stats
+
+
+def profile_report(fmt="text"):
+    '''Return report of all profiled functions as text or json. '''
+    stats = profile_stats()
+    if fmt == "json":
+        return json.dumps(stats, indent=2)
+
+    def ns(t):
+        for unit, scale in (("s", 10**9), ("ms", 10**6), ("us", 10**3)):
+            if t >= scale:
+                return f"{t / scale:.1f}{unit}"
+        return f"{t}ns"
+
+    lines = []
+    for name, st in sorted(stats.items(), key=lambda x: -x[1]["total_ns"]):
+        lines.append(f"{name}: calls={st['calls']} total={ns(st['total_ns'])}"
+                     f" min={ns(st['min_ns'])} max={ns(st['max_ns'])}")
+        for upper, n in st["histogram"].items():
+            lines.append(f"    <{ns(upper):>8} {n}")
+    return "\n".join(lines)
+
+
+def profile_reset():
+    '''Drop all gathered profile records. '''
+    for records in profiles.values():
+        for rec, samples in records:
+            rec[:] = _new_record()
+            samples.clear()
+
+
 @memo
 @countcalls
 @n_ary
@@ -128,6 +593,11 @@ def bar(a, b):
     return a * b
 
 
+@n_ary(associative=True)
+def add(a, b):
+    return a + b
+
+
 @countcalls
 @trace("####")
 @memo
@@ -136,7 +606,240 @@ def fib(n):
     return 1 if n <= 1 else fib(n-1) + fib(n-2)
 
 
-def main():
+def bench_async_memo(n_callers=100, n_keys=5, delay=0.01):
+    '''Compare backend calls of a slow coroutine with and without
+    async_memo when many callers request the same keys at once. '''
+    backend = {'n': 0}
+
+    async def lookup(key):
+        backend['n'] += 1
+        await asyncio.sleep(delay)
+        return key * 2
+
+    async def run(func):
+        backend['n'] = 0
+        await asyncio.gather(*[func(i % n_keys) for i in range(n_callers)])
+        return backend['n']
+
+    print("plain lookup backend calls:", asyncio.run(run(lookup)))
+    memo_lookup = async_memo(maxsize=n_keys)(lookup)
+    print("async_memo lookup backend calls:",
+          asyncio.run(run(memo_lookup)))
+    print("async_memo stats:", memo_lookup.stats)
+
+
+def bench_call_overhead(n=100_000):
+    '''Measure time per call of the decorated foo, bar and fib. '''
+    calls = (("foo(4, 3)", lambda: foo(4, 3)),
+             ("foo(4, 3, 2)", lambda: foo(4, 3, 2)),
+             ("bar(4, 3, 2, 1)", lambda: bar(4, 3, 2, 1)),
+             ("fib(3)", lambda: fib(3)))
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        timings = [(name, timeit(f, number=n) / n) for name, f in calls]
+    for name, t in timings:
+        print(f"{name}: {t * 1e9:.0f} ns per call")
+
+
+def bench_profile(n=1_000_000):
+    '''Measure per-call overhead added by profile. '''
+    def noop(x):
+        return x
+
+    profiled = profile()(noop)
+    for name, func in (("plain", noop), ("profile", profiled)):
+        t0 = perf_counter_ns()
+        for i in range(n):
+            func(i)
+        print(f"{name}: {(perf_counter_ns() - t0) / n:.0f} ns per call")
+    profiles.pop(f"{noop.__module__}.{noop.__qualname__}")
+
+
+def test_countcalls_memo():
+    print("test_countcalls_memo...")
+
+    @memo
+    @countcalls
+    def misses(x):
+        return x
+
+    @countcalls
+    @memo
+    def every(x):
+        return x
+
+    @countcalls
+    @trace("")
+    @memo
+    def traced(x):
+        return x
+
+    @memo
+    @countcalls
+    @n_ary
+    def mul(a, b):
+        return a * b
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for func in (misses, every, traced):
+            assert [func(x) for x in (1, 2, 1, 1)] == [1, 2, 1, 1]
+        assert [mul(2, 3), mul(2, 3, 4), mul(2, 3)] == [6, 24, 6]
+    assert misses.calls == {'n': 2} and misses.__name__ == "misses"
+    assert every.calls == {'n': 4} and every.__name__ == "every"
+    assert traced.calls == {'n': 4}
+    assert mul.calls == {'n': 2}
+
+
+def test_async_memo():
+    print("test_async_memo...")
+    backend = []
+
+    @async_memo(maxsize=2)
+    async def lookup(key, delay=0.01):
+        backend.append(key)
+        await asyncio.sleep(delay)
+        return key * 2
+
+    async def coalescing():
+        res = await asyncio.gather(*[lookup(1) for _ in range(10)])
+        assert res == [2] * 10 and backend == [1]
+        assert lookup.stats == {'hits': 0, 'misses': 1,
+                                'coalesced': 9, 'evictions': 0}
+        assert await lookup(1) == 2 and lookup.stats['hits'] == 1
+
+    async def cancellation():
+        try:
+            await asyncio.wait_for(lookup(2, delay=0.05), 0.01)
+        except asyncio.TimeoutError:
+            pass
+        # Call started by the cancelled caller is still shared...
+        assert await lookup(2, delay=0.05) == 4
+        # ...and its result is cached
+        assert await lookup(2, delay=0.05) == 4
+        assert backend == [2] and lookup.stats['coalesced'] == 1
+        assert lookup.stats['hits'] == 1
+
+    async def eviction():
+        for key in (1, 2, 1, 3):
+            await lookup(key)
+        assert backend == [1, 2, 3]
+        assert lookup.stats['evictions'] == 1
+        await lookup(2)
+        assert backend == [1, 2, 3, 2]
+
+    for case in (coalescing, cancellation, eviction):
+        lookup.cache_clear()
+        backend.clear()
+        asyncio.run(case())
+
+    @async_memo(maxsize=1)
+    def square(x):
+        backend.append(x)
+        return x * x
+
+    backend.clear()
+    assert [square(2), square(2), square(3), square(2)] == [4, 4, 9, 4]
+    assert backend == [2, 3, 2]
+    assert square.stats == {'hits': 1, 'misses': 3,
+                            'coalesced': 0, 'evictions': 2}
+
+
+def test_disk_memo():
+    print("test_disk_memo...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+
+        # Fresh interpreters with different hash seeds share entries,
+        # set arguments included
+        probe = ("import sys\n"
+                 "from deco import disk_memo\n"
+                 "@disk_memo(sys.argv[1])\n"
+                 "def size(items):\n"
+                 "    return len(items)\n"
+                 "size({'x', 'y', 'z'}), size([frozenset('abc')])\n"
+                 "print(size.stats['hits'], size.stats['misses'])\n")
+        runs = [subprocess.run([sys.executable, "-c", probe, path],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=dict(os.environ, PYTHONHASHSEED=seed),
+                               capture_output=True, text=True, check=True)
+                for seed in ("1", "2")]
+        assert [run.stdout.split() for run in runs] == [["0", "2"],
+                                                          ["2", "0"]]
+
+        @disk_memo(path, maxsize=2)
+        def double(x):
+            return x * 2
+
+        for x in (1, 2, 1, 3, 1, 2):
+            assert double(x) == x * 2
+        assert double.stats == {'hits': 2, 'misses': 4}
+
+        # Same body and version hit entries of the previous definition
+        @disk_memo(path, maxsize=2)
+        def double(x):
+            return x * 2
+
+        assert double(2) == 4 and double.stats['hits'] == 1
+
+        @disk_memo(path, maxsize=2)
+        def double(x):
+            return x + x
+
+        assert double(2) == 4 and double.stats['misses'] == 1
+
+        @disk_memo(path, maxsize=2, version="2")
+        def double(x):
+            return x * 2
+
+        assert double(2) == 4 and double.stats['misses'] == 1
+
+
+def test_n_ary():
+    print("test_n_ary...")
+    assert add(1) == 1 and add(1, 2, 3) == 6
+    assert add.__name__ == "add" and add.reduce(range(1000)) == 499500
+    n = 100_000
+    with ProcessPoolExecutor(2) as pool:
+        assert add.reduce(range(n), pool, chunksize=1000, window=4) == \
+            n * (n - 1) // 2
+    with multiprocessing.Pool(2) as pool:
+        assert add.reduce(range(n), pool, chunksize=1000) == n * (n - 1) // 2
+        assert add.reduce(iter([5]), pool) == 5
+
+    def fails(call, exc=TypeError):
+        try:
+            call()
+        except exc:
+            return True
+        return False
+
+    assert fails(lambda: add.reduce([]))
+    assert fails(lambda: add.reduce([], pool=map))
+    assert fails(lambda: n_ary(lambda a, b: a - b).reduce(iter([])))
+    assert fails(lambda: memo())
+    assert fails(lambda: countcalls())
+
+
+def test_profile():
+    print("test_profile...")
+
+    @profile(sample_every=2, max_samples=3)
+    def nap(seconds):
+        time.sleep(seconds)
+
+    for seconds in (0.002, 0, 0.001, 0, 0, 0, 0, 0):
+        nap(seconds)
+    name = f"{nap.__module__}.{nap.__qualname__}"
+    stats = profile_stats()[name]
+    assert stats["calls"] == 8 == sum(stats["histogram"].values())
+    assert 2_000_000 <= stats["max_ns"] < 1 << 63
+    assert stats["min_ns"] < 1_000_000
+    assert stats["samples"] == ["(0,), {}"] * 3
+    profile_reset()
+    assert name not in profile_stats()
+    profiles.pop(name)
+
+
+def main(bench=False):
     print(foo(4, 3))
     print(foo(4, 3, 2))
     print(foo(4, 3))
@@ -152,6 +855,16 @@ def main():
     fib(3)
     print(fib.calls, 'calls made')
 
+    if bench:
+        bench_call_overhead()
+        bench_async_memo()
+        bench_profile()
+
 
 if __name__ == '__main__':
-    main()
+    test_countcalls_memo()
+    test_async_memo()
+    test_disk_memo()
+    test_n_ary()
+    test_profile()
+    main(bench="--bench" in sys.argv[1:])